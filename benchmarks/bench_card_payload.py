@@ -0,0 +1,57 @@
+# compares the json size of a listing page of full product documents against the
+# same page as product cards, for a growing number of reviews per product.
+# run from the repo root: python -m benchmarks.bench_card_payload
+import json
+import random
+import string
+from bson import ObjectId
+from microservices.product_microservice import PRODUCT_CARD_PROJECTION
+
+PER_PAGE = 8
+REVIEWS_PER_PRODUCT = [0, 10, 100, 1000]
+
+
+def random_text(length):
+    return "".join(random.choice(string.ascii_lowercase + " ") for _ in range(length))
+
+
+def make_product(reviews):
+    ratings = [{"username": random_text(8), "user_id": str(ObjectId()), "details": random_text(200),
+                "rating": random.randint(1, 5)} for _ in range(reviews)]
+    return {
+        "_id": str(ObjectId()),
+        "seller": random_text(10),
+        "name": random_text(30),
+        "category": "Electronics",
+        "details": random_text(1500),
+        "tags": [random_text(6) for _ in range(5)],
+        "price": round(random.uniform(5, 500), 2),
+        "images": [f"https://bucket.s3.amazonaws.com/{random_text(20)}" for _ in range(4)],
+        "ratings": ratings,
+        "rating_sum": sum(rating["rating"] for rating in ratings),
+        "rating_count": len(ratings),
+        "average_rating": sum(rating["rating"] for rating in ratings) / len(ratings) if ratings else None,
+    }
+
+
+def to_card(product):
+    # what the PRODUCT_CARD_PROJECTION $project stage returns
+    card = {"_id": product["_id"]}
+    for field in PRODUCT_CARD_PROJECTION:
+        card[field] = product[field][:1] if field == "images" else product[field]
+    return card
+
+
+def main():
+    random.seed(0)
+    print(f"{'reviews':>8} {'full bytes':>12} {'card bytes':>11} {'ratio':>8}")
+    for reviews in REVIEWS_PER_PRODUCT:
+        page = [make_product(reviews) for _ in range(PER_PAGE)]
+        full_size = len(json.dumps({"products": page}))
+        card_size = len(json.dumps(
+            {"products": [to_card(product) for product in page]}))
+        print(f"{reviews:>8} {full_size:>12} {card_size:>11} {full_size / card_size:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# compares the per-product extractOne loops against the search index and its
+# cdist scoring on synthetic catalogs.
+# run from the repo root: python -m benchmarks.bench_search_scoring
+import random
+import string
+import time
+from rapidfuzz import process, utils
+from microservices.search_microservice import SearchIndex, product_search_terms
+
+CATALOG_SIZES = [1_000, 10_000, 100_000]
+SEARCHES = ["running shoes", "gaming laptop", "iphone case", "lego"]
+TAGS = ["shoes sport", "laptop", "phone case"]
+WORDS = ["running", "shoes", "sport", "gaming", "laptop", "phone", "case", "lego", "blue", "cotton",
+         "kids", "pro", "max", "wireless", "charger", "leather", "watch", "desk", "lamp", "book"]
+CATEGORIES = ["Clothing", "Electronics", "Toys", "Home", "Books"]
+
+
+def random_word():
+    if random.random() < 0.6:
+        return random.choice(WORDS)
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(3, 9)))
+
+
+def make_catalog(size):
+    return [{
+        "_id": i,
+        "name": " ".join(random_word() for _ in range(random.randint(2, 5))),
+        "category": random.choice(CATEGORIES),
+        "tags": [random_word() for _ in range(random.randint(2, 5))],
+    } for i in range(size)]
+
+
+def loop_search(products, search):
+    # the previous get_search_query implementation
+    scores = {}
+    for product in products:
+        product_score = process.extractOne(search, product_search_terms(
+            product), processor=utils.default_process)
+        if product_score[1] > 85:
+            scores[product["_id"]] = product_score[1]
+    return scores
+
+
+def loop_tags(products, tags):
+    # the previous get_products_from_tags implementation
+    matching_ids = set()
+    for product in products:
+        for tag_string in tags:
+            product_score = process.extractOne(
+                tag_string, product["tags"], processor=utils.default_process)
+            if product_score[2] <= 1 and product_score[1] >= 80:
+                matching_ids.add(product["_id"])
+    return matching_ids
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    random.seed(0)
+    print(f"{'products':>9} {'case':>8} {'loop ms':>10} {'engine ms':>10} {'speedup':>8}")
+    for size in CATALOG_SIZES:
+        products = make_catalog(size)
+        index = SearchIndex()
+        _, build_time = timed(index.rebuild, products)
+        index.search(SEARCHES[0])  # first search compiles the flat arrays
+        loop_total = engine_total = 0
+        for search in SEARCHES:
+            expected, loop_time = timed(loop_search, products, search)
+            result, engine_time = timed(index.search, search)
+            assert result == expected, f"search results differ for {search!r}"
+            loop_total += loop_time
+            engine_total += engine_time
+        print(f"{size:>9} {'search':>8} {loop_total / len(SEARCHES) * 1000:>10.1f} "
+              f"{engine_total / len(SEARCHES) * 1000:>10.1f} {loop_total / engine_total:>7.1f}x")
+        expected, loop_time = timed(loop_tags, products, TAGS)
+        result, engine_time = timed(index.match_tags, TAGS)
+        assert result == expected, "tag results differ"
+        print(f"{size:>9} {'tags':>8} {loop_time * 1000:>10.1f} "
+              f"{engine_time * 1000:>10.1f} {loop_time / engine_time:>7.1f}x")
+        print(f"{size:>9} {'build':>8} {'':>10} {build_time * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# fires a burst of concurrent signin password checks at a small app while an unrelated
+# endpoint is polled, and reports the latency of the polled endpoint. the checks run
+# inline on the event loop the way signin used to, then on the bcrypt pool.
+# run from the repo root: python -m benchmarks.load_signin_burst
+import asyncio
+import time
+import bcrypt
+import httpx
+from fastapi import FastAPI
+from microservices.users_microservice import BCRYPT_ROUNDS, PASSWORD_QUEUE_LIMIT, PASSWORD_WORKERS, compare_passwords
+
+SIGNINS = 40
+PING_INTERVAL = 0.01
+PASSWORD = "hunter22"
+HASHED = bcrypt.hashpw(PASSWORD.encode(),
+                       bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+app = FastAPI()
+
+
+@app.get("/ping")
+async def ping():
+    return {"status": "success"}
+
+
+@app.post("/signin-inline")
+async def signin_inline():
+    return {"status": "success" if bcrypt.checkpw(PASSWORD.encode(), HASHED.encode()) else "failure"}
+
+
+@app.post("/signin-pooled")
+async def signin_pooled():
+    return {"status": "success" if await compare_passwords(PASSWORD, HASHED) else "failure"}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(client, signin_path):
+    latencies = []
+    done = asyncio.Event()
+
+    async def poll():
+        # latency is taken from when each ping was due, so time spent waiting for a
+        # blocked event loop to send it is counted too
+        due = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            await client.get("/ping")
+            latencies.append(time.perf_counter() - due)
+            due += PING_INTERVAL
+
+    poller = asyncio.create_task(poll())
+    await asyncio.sleep(0.1)
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.post(signin_path) for _ in range(SIGNINS)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await poller
+    statuses = [response.status_code for response in responses]
+    return {
+        "elapsed": elapsed,
+        "ok": statuses.count(200),
+        "shed": statuses.count(503),
+        "pings": len(latencies),
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "max": max(latencies) * 1000,
+    }
+
+
+async def main():
+    print(f"{SIGNINS} signins, bcrypt cost {BCRYPT_ROUNDS}, {PASSWORD_WORKERS} workers, queue limit {PASSWORD_QUEUE_LIMIT}")
+    print(f"{'mode':>8} {'burst s':>8} {'ok':>4} {'503':>4} {'pings':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        for mode in ("inline", "pooled"):
+            result = await run(client, f"/signin-{mode}")
+            print(f"{mode:>8} {result['elapsed']:>8.2f} {result['ok']:>4} {result['shed']:>4} {result['pings']:>6} "
+                  f"{result['p50']:>8.1f} {result['p99']:>8.1f} {result['max']:>8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -2,8 +2,12 @@ from datetime import datetime, timedelta, timezone
 import os
 import random
 import re
-import jwt
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
 from email_validator import validate_email as email_verification, EmailNotValidError
+from microservices.cache_microservice import TTLCache
+from microservices.token_microservice import ACCESS_TOKEN_LIFETIME, encode_token
 
 
 def validate_user_details(user):
@@ -11,7 +15,8 @@ def validate_user_details(user):
     if (1 > len(user.name) > 12):
         return False
     try:
-        email_verification(user.email, check_deliverability=True)
+        # deliverability needs dns, it is checked with is_domain_deliverable
+        email_verification(user.email, check_deliverability=False)
     except EmailNotValidError as e:
         return False
     if (4 > len(user.password) > 12 or re.search(r'\s', user.password)):
@@ -19,6 +24,59 @@ def validate_user_details(user):
     return True
 
 
+# domain -> whether it accepts mail, undeliverable answers are kept for less time
+DOMAIN_CHECK_SECONDS = float(os.getenv("DOMAIN_CHECK_SECONDS", 24 * 60 * 60))
+UNDELIVERABLE_DOMAIN_SECONDS = float(
+    os.getenv("UNDELIVERABLE_DOMAIN_SECONDS", 10 * 60))
+DNS_TIMEOUT_SECONDS = float(os.getenv("DNS_TIMEOUT_SECONDS", 5))
+domain_deliverability = TTLCache(maxsize=10000, ttl=DOMAIN_CHECK_SECONDS)
+# anything with dnspython's async resolve(name, rdtype, lifetime=...), set_email_resolver swaps it
+_email_resolver = None
+
+
+def set_email_resolver(resolver):
+    global _email_resolver
+    _email_resolver = resolver
+    domain_deliverability.clear()
+
+
+async def _resolve(domain: str, rdtype: str):
+    try:
+        return await _email_resolver.resolve(domain, rdtype, lifetime=DNS_TIMEOUT_SECONDS)
+    except dns.resolver.NoAnswer:
+        return None
+
+
+async def lookup_domain_deliverability(domain: str):
+    # same rules as email_validator: an MX other than the null MX, or else an A or AAAA record.
+    # returns None when dns could not answer, the signup is not refused over that
+    global _email_resolver
+    if _email_resolver is None:
+        _email_resolver = dns.asyncresolver.Resolver()
+    try:
+        mx = await _resolve(domain, "MX")
+        if mx is not None:
+            return any(str(record.exchange) not in ("", ".") for record in mx)
+        return bool(await _resolve(domain, "A") or await _resolve(domain, "AAAA"))
+    except dns.resolver.NXDOMAIN:
+        return False
+    except dns.exception.DNSException as e:
+        print(f"Error checking email domain {domain}: {e}")
+        return None
+
+
+async def is_domain_deliverable(email: str):
+    domain = email.rsplit("@", 1)[-1].lower()
+    deliverable = domain_deliverability.get(domain)
+    if deliverable is None:
+        deliverable = await lookup_domain_deliverability(domain)
+        if deliverable is None:
+            return True
+        domain_deliverability.set(domain, deliverable,
+                                  ttl=None if deliverable else UNDELIVERABLE_DOMAIN_SECONDS)
+    return deliverable
+
+
 def generate_refresh_token(email: str, verified: bool, rememberMe: bool):
     # Calculate expiration time
     expire = datetime.now(timezone.utc) + timedelta(
@@ -27,18 +85,17 @@ def generate_refresh_token(email: str, verified: bool, rememberMe: bool):
     # Payload
     to_encode = {"sub": email, "verified": verified, "exp": expire_timestamp}
     # Generate refresh token
-    refresh_token = jwt.encode(to_encode, os.getenv(
-        "JWT_SECRET_REFRESH"), algorithm="HS256")
+    refresh_token = encode_token(to_encode, "JWT_SECRET_REFRESH")
     return refresh_token
 
 
 def generate_access_token(email: str, verified: bool):
     # expiration time for the access token
-    expire = datetime.now(timezone.utc) + timedelta(minutes=0.1)
+    expire = datetime.now(timezone.utc) + ACCESS_TOKEN_LIFETIME
     # payload
-    to_encode = {"sub": email, "verified": verified, "exp": expire}
-    access_token = jwt.encode(to_encode, os.getenv(
-        "JWT_SECRET_ACCESS"), algorithm="HS256")
+    to_encode = {"sub": email, "verified": verified,
+                 "exp": int(expire.timestamp())}
+    access_token = encode_token(to_encode, "JWT_SECRET_ACCESS")
     return access_token
 
 
@@ -0,0 +1,257 @@
+import asyncio
+import os
+from mongomanager import users_collection
+
+# "redis" keeps hot carts in redis hashes shared by every worker and writes them back to the
+# user documents in the background. "memory" does the same inside one process, for tests
+# and single worker runs. unset, every cart call reads and writes the user document
+CART_STORE = os.getenv("CART_STORE", "")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# longest a cart change waits before it is written to the user document
+CART_FLUSH_SECONDS = float(os.getenv("CART_FLUSH_SECONDS", 5))
+# carts nobody touched for this long are dropped from redis, they are loaded again when needed
+CART_TTL_SECONDS = int(os.getenv("CART_TTL_SECONDS", 24 * 60 * 60))
+CART_FLUSH_BATCH = 500
+
+
+async def load_cart(email: str):
+    # the cart stored on the user document and its version, None if there is no such user
+    user = await users_collection.find_one({"email": email}, {"cart": 1, "cart_version": 1})
+    if user is None:
+        return None
+    return {item["product_id"]: item["quantity"] for item in user.get("cart", [])}, user.get("cart_version", 0)
+
+
+async def save_cart(email: str, cart: dict, version: int):
+    # every change bumps the version, so a slow flush never overwrites a newer one
+    await users_collection.update_one(
+        {"email": email, "$or": [{"cart_version": {"$lt": version}}, {"cart_version": {"$exists": False}}]},
+        {"$set": {"cart": [{"product_id": id, "quantity": quantity} for id, quantity in cart.items()],
+                  "cart_version": version}})
+
+
+class CartStore:
+    # hot carts as product_id -> quantity maps. every change marks the cart dirty and the
+    # flusher writes dirty carts back to the user documents every CART_FLUSH_SECONDS.
+    # subclasses provide the storage, each of their operations is atomic on its own
+    def __init__(self):
+        self._flusher = None
+
+    async def get_cart(self, email: str):
+        stored = await self._get(email)
+        if stored is None:
+            if not await self._hydrate(email):
+                return None
+            stored = await self._get(email) or ({}, 0)
+        cart, _ = stored
+        return [{"product_id": id, "quantity": quantity} for id, quantity in cart.items()]
+
+    async def add_items(self, email: str, quantities: dict):
+        # quantities may be negative, items brought to 0 or less by that are removed.
+        # False if there is no such user
+        for _ in range(2):
+            if await self._incr(email, quantities):
+                await self._mark_dirty(email)
+                return True
+            # not hot, or expired in between: load it from the user document and try again
+            if not await self._hydrate(email):
+                return False
+        return False
+
+    async def remove_item(self, email: str, product_id: str):
+        for _ in range(2):
+            if await self._remove(email, product_id):
+                await self._mark_dirty(email)
+                return True
+            if not await self._hydrate(email):
+                return False
+        return False
+
+    async def _hydrate(self, email: str):
+        stored = await load_cart(email)
+        if stored is None:
+            return False
+        await self._set_if_missing(email, *stored)
+        return True
+
+    async def _write_back(self, email: str):
+        stored = await self._get(email)
+        if stored is None:
+            return
+        try:
+            await save_cart(email, *stored)
+        except Exception as e:
+            print(f"Error flushing cart of {email}: {e}")
+            await self._mark_dirty(email)
+
+    async def flush(self, email: str = None):
+        # writes one dirty cart, or all of them, to the user documents now.
+        # claiming a cart unmarks it, so workers never write the same change twice
+        if email is not None:
+            if await self._claim(email):
+                await self._write_back(email)
+            return
+        while True:
+            emails = await self._claim_batch(CART_FLUSH_BATCH)
+            if not emails:
+                return
+            await asyncio.gather(*(self._write_back(email) for email in emails))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(CART_FLUSH_SECONDS)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing carts: {e}")
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+
+class MemoryCartStore(CartStore):
+    def __init__(self):
+        super().__init__()
+        self.carts = {}
+        self.versions = {}
+        self.dirty = set()
+
+    async def _get(self, email):
+        cart = self.carts.get(email)
+        return None if cart is None else (dict(cart), self.versions[email])
+
+    async def _set_if_missing(self, email, cart, version):
+        if email not in self.carts:
+            self.carts[email] = dict(cart)
+            self.versions[email] = version
+
+    async def _incr(self, email, quantities):
+        cart = self.carts.get(email)
+        if cart is None:
+            return False
+        for id, quantity in quantities.items():
+            cart[id] = cart.get(id, 0) + quantity
+            if quantity < 0 and cart[id] <= 0:
+                del cart[id]
+        self.versions[email] += 1
+        return True
+
+    async def _remove(self, email, product_id):
+        cart = self.carts.get(email)
+        if cart is None:
+            return False
+        cart.pop(product_id, None)
+        self.versions[email] += 1
+        return True
+
+    async def _mark_dirty(self, email):
+        self.dirty.add(email)
+
+    async def _claim(self, email):
+        if email in self.dirty:
+            self.dirty.discard(email)
+            return True
+        return False
+
+    async def _claim_batch(self, count):
+        emails = []
+        while self.dirty and len(emails) < count:
+            emails.append(self.dirty.pop())
+        return emails
+
+
+# a cart hash always holds its version, so an empty cart is told apart from one not loaded
+_VERSION_FIELD = "_version"
+_SET_IF_MISSING = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('hset', KEYS[1], unpack(ARGV, 2))
+end
+redis.call('expire', KEYS[1], ARGV[1])
+"""
+_INCR = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    local delta = tonumber(ARGV[i + 1])
+    if redis.call('hincrby', KEYS[1], ARGV[i], delta) <= 0 and delta < 0 then
+        redis.call('hdel', KEYS[1], ARGV[i])
+    end
+end
+redis.call('hincrby', KEYS[1], '_version', 1)
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+"""
+_REMOVE = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('hdel', KEYS[1], ARGV[2])
+redis.call('hincrby', KEYS[1], '_version', 1)
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class RedisCartStore(CartStore):
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.dirty_key = "cart:dirty"
+        self._set_if_missing_script = client.register_script(_SET_IF_MISSING)
+        self._incr_script = client.register_script(_INCR)
+        self._remove_script = client.register_script(_REMOVE)
+
+    def _key(self, email):
+        return f"cart:{email}"
+
+    async def _get(self, email):
+        cart = await self.client.hgetall(self._key(email))
+        if not cart:
+            return None
+        version = int(cart.pop(_VERSION_FIELD))
+        return {id: int(quantity) for id, quantity in cart.items()}, version
+
+    async def _set_if_missing(self, email, cart, version):
+        fields = [_VERSION_FIELD, version]
+        for id, quantity in cart.items():
+            fields += [id, quantity]
+        await self._set_if_missing_script(keys=[self._key(email)], args=[CART_TTL_SECONDS, *fields])
+
+    async def _incr(self, email, quantities):
+        args = [CART_TTL_SECONDS]
+        for id, quantity in quantities.items():
+            args += [id, quantity]
+        return bool(await self._incr_script(keys=[self._key(email)], args=args))
+
+    async def _remove(self, email, product_id):
+        return bool(await self._remove_script(keys=[self._key(email)], args=[CART_TTL_SECONDS, product_id]))
+
+    async def _mark_dirty(self, email):
+        await self.client.sadd(self.dirty_key, email)
+
+    async def _claim(self, email):
+        return bool(await self.client.srem(self.dirty_key, email))
+
+    async def _claim_batch(self, count):
+        return await self.client.spop(self.dirty_key, count) or []
+
+
+def make_cart_store(kind: str):
+    if kind == "redis":
+        import redis.asyncio
+        return RedisCartStore(redis.asyncio.from_url(REDIS_URL, decode_responses=True))
+    if kind == "memory":
+        return MemoryCartStore()
+    return None
+
+
+cart_store = make_cart_store(CART_STORE)
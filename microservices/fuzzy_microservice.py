@@ -0,0 +1,36 @@
+import numpy as np
+from rapidfuzz import fuzz, process, utils
+
+
+def flatten_terms(product_terms):
+    # lays out every product's term ids in one flat array, with the offset where
+    # each product starts and how many terms it has
+    counts = np.fromiter(map(len, product_terms), dtype=np.int64,
+                         count=len(product_terms))
+    offsets = np.zeros(len(product_terms), dtype=np.int64)
+    np.cumsum(counts[:-1], out=offsets[1:])
+    flat = np.fromiter((term_id for terms in product_terms for term_id in terms),
+                       dtype=np.int64, count=int(counts.sum()))
+    return flat, offsets, counts
+
+
+def score_terms(queries, terms):
+    # scores every query against every term in one multithreaded call, one row per query.
+    # float64 keeps the scores identical to process.extractOne
+    if not len(queries) or not len(terms):
+        return np.zeros((len(queries), len(terms)))
+    return process.cdist(queries, terms, scorer=fuzz.WRatio, processor=utils.default_process,
+                         dtype=np.float64, workers=-1)
+
+
+def max_per_product(term_scores, flat, offsets, counts):
+    # reduces a (queries x terms) score matrix to each product's best score per query
+    if not len(offsets):
+        return np.zeros((len(term_scores), 0))
+    gathered = term_scores[:, flat]
+    # extra column so the offset of a trailing product without terms stays in range
+    gathered = np.concatenate(
+        (gathered, np.zeros((len(term_scores), 1))), axis=1)
+    best = np.maximum.reduceat(gathered, offsets, axis=1)
+    best[:, counts == 0] = 0
+    return best
@@ -0,0 +1,67 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PIL import Image, ImageOps
+
+# widths the uploaded images are resized to, cards for listings and detail for the product page
+IMAGE_VARIANT_WIDTHS = {"card": 320, "detail": 960}
+WEBP_QUALITY = 80
+# decoding and encoding is cpu bound, so it runs in worker processes
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+_image_pool = None
+
+
+def render_variants(path: str):
+    # runs in a worker process: decodes the image file once and encodes every width as WebP.
+    # images narrower than a width are encoded at their own size, never upscaled
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert(
+                "RGBA" if "A" in image.getbands() else "RGB")
+        variants = {}
+        for name, width in IMAGE_VARIANT_WIDTHS.items():
+            variant = image
+            if image.width > width:
+                height = max(1, round(image.height * width / image.width))
+                variant = image.resize((width, height), Image.LANCZOS)
+            output = BytesIO()
+            variant.save(output, "WEBP", quality=WEBP_QUALITY)
+            variants[name] = output.getvalue()
+        return variants
+
+
+def copy_to_temp_file(file, chunk_size=1024 * 1024):
+    # the spooled upload has no path the worker processes could open, so it is copied
+    # in chunks to a named temporary file instead of being read into memory
+    file.seek(0)
+    with tempfile.NamedTemporaryFile(prefix="upload_", delete=False) as temp_file:
+        shutil.copyfileobj(file, temp_file, chunk_size)
+    file.seek(0)
+    return temp_file.name
+
+
+async def make_image_variants(file):
+    # file is the spooled upload, only the worker process decodes it
+    global _image_pool
+    if _image_pool is None:
+        # spawned workers, forking a server that already runs threads can deadlock
+        _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                          mp_context=multiprocessing.get_context("spawn"))
+    path = await asyncio.to_thread(copy_to_temp_file, file)
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_image_pool, render_variants, path)
+    finally:
+        os.unlink(path)
+
+
+def shutdown_image_pool():
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(cancel_futures=True)
+        _image_pool = None
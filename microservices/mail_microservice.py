@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from collections import deque
+from email.message import EmailMessage
+from email.utils import formataddr
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+from schemas.auth_schemas import conf
+
+# each worker keeps one smtp connection open, so this caps both connections and concurrent sends
+MAIL_CONNECTIONS = int(os.getenv("MAIL_CONNECTIONS", 2))
+MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 1000))
+MAIL_RETRIES = int(os.getenv("MAIL_RETRIES", 3))
+MAIL_RETRY_SECONDS = float(os.getenv("MAIL_RETRY_SECONDS", 1))
+# connections idle for longer are closed before the server drops them
+MAIL_IDLE_SECONDS = float(os.getenv("MAIL_IDLE_SECONDS", 60))
+# how long shutdown waits for queued emails
+MAIL_DRAIN_SECONDS = float(os.getenv("MAIL_DRAIN_SECONDS", 10))
+
+
+class Mailer:
+    # sends emails from a queue over a small pool of persistent smtp connections
+    def __init__(self, conf: ConnectionConfig, connections: int = MAIL_CONNECTIONS, queue_size: int = MAIL_QUEUE_SIZE,
+                 retries: int = MAIL_RETRIES, retry_seconds: float = MAIL_RETRY_SECONDS):
+        self.conf = conf
+        self.connections = connections
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_seconds = retry_seconds
+        self.queue = None
+        self.workers = []
+        self.pending_retries = {}  # retry timer -> the job it will queue again
+        self.stopping = False
+        self.open_connections = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)  # seconds from enqueue to sent
+
+    def start(self):
+        # also replaces workers that ended, so the pool never shrinks for good
+        self.workers = [worker for worker in self.workers if not worker.done()]
+        if len(self.workers) >= self.connections:
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.stopping = False
+        self.workers += [asyncio.create_task(self._worker())
+                         for _ in range(self.connections - len(self.workers))]
+
+    async def stop(self):
+        if not self.workers:
+            return
+        # retries waiting for their delay are sent now instead of being lost with the loop
+        self.stopping = True
+        for timer, job in list(self.pending_retries.items()):
+            timer.cancel()
+            self._retry(job, timer)
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=MAIL_DRAIN_SECONDS)
+        except asyncio.TimeoutError:
+            print(f"Mailer stopped with {self.queue.qsize()} emails unsent")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def build_message(self, recipient: str, subject: str, body: str):
+        message = EmailMessage()
+        message["From"] = formataddr((self.conf.MAIL_FROM_NAME, self.conf.MAIL_FROM))
+        message["To"] = recipient
+        message["Subject"] = subject
+        message.set_content(body)
+        return message
+
+    def enqueue(self, message: EmailMessage):
+        # False when the queue is full, the caller decides how to tell the user
+        self.start()
+        try:
+            self.queue.put_nowait((message, time.monotonic(), 0))
+            return True
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+
+    def _schedule_retry(self, job, delay):
+        if self.stopping:
+            self._retry(job)
+            return
+        timer = None
+
+        def retry():
+            self._retry(job, timer)
+        timer = asyncio.get_running_loop().call_later(delay, retry)
+        self.pending_retries[timer] = job
+
+    def _retry(self, job, timer=None):
+        self.pending_retries.pop(timer, None)
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.failed += 1
+            print(f"Dropped email to {job[0]['To']}, mail queue is full")
+
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(
+            hostname=self.conf.MAIL_SERVER,
+            port=self.conf.MAIL_PORT,
+            use_tls=self.conf.MAIL_SSL_TLS,
+            start_tls=self.conf.MAIL_STARTTLS,
+            validate_certs=self.conf.VALIDATE_CERTS,
+            timeout=self.conf.TIMEOUT,
+        )
+        await smtp.connect()
+        if self.conf.USE_CREDENTIALS:
+            await smtp.login(self.conf.MAIL_USERNAME, self.conf.MAIL_PASSWORD.get_secret_value())
+        self.open_connections += 1
+        return smtp
+
+    async def _close(self, smtp):
+        self.open_connections -= 1
+        try:
+            await smtp.quit()
+        except (aiosmtplib.SMTPException, OSError):
+            smtp.close()
+
+    async def _worker(self):
+        smtp = None
+        try:
+            while True:
+                try:
+                    job = await asyncio.wait_for(self.queue.get(), timeout=MAIL_IDLE_SECONDS if smtp else None)
+                except asyncio.TimeoutError:
+                    await self._close(smtp)
+                    smtp = None
+                    continue
+                message, enqueued_at, attempt = job
+                try:
+                    if smtp is not None and not smtp.is_connected:
+                        await self._close(smtp)
+                        smtp = None
+                    if smtp is None:
+                        smtp = await self._connect()
+                    await smtp.send_message(message)
+                    self.sent += 1
+                    self.latencies.append(time.monotonic() - enqueued_at)
+                except (aiosmtplib.SMTPException, OSError) as e:
+                    if smtp is not None:
+                        await self._close(smtp)
+                        smtp = None
+                    # refused addresses and other 5xx answers won't succeed on a retry
+                    permanent = isinstance(e, (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPSenderRefused)) or \
+                        (isinstance(e, aiosmtplib.SMTPResponseException) and e.code >= 500)
+                    if permanent or attempt >= self.retries:
+                        self.failed += 1
+                        print(f"Error sending email to {message['To']}: {e}")
+                    else:
+                        self.retried += 1
+                        self._schedule_retry((message, enqueued_at, attempt + 1), self.retry_seconds * 2 ** attempt)
+                except Exception as e:
+                    # a bug or an odd message must not take the worker down with it
+                    if smtp is not None:
+                        await self._close(smtp)
+                        smtp = None
+                    self.failed += 1
+                    print(f"Error sending email to {message['To']}: {e}")
+                finally:
+                    self.queue.task_done()
+        finally:
+            if smtp is not None:
+                self.open_connections -= 1
+                smtp.close()
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "retrying": len(self.pending_retries),
+            "queue_size": self.queue_size,
+            "connections": self.open_connections,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rejected": self.rejected,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        }
+
+
+mailer = Mailer(conf)
@@ -0,0 +1,59 @@
+import base64
+from bson import json_util
+from fastapi import HTTPException
+
+
+def encode_cursor(last_values: dict):
+    # opaque cursor holding the sort key values of the last row a client received
+    return base64.urlsafe_b64encode(json_util.dumps(last_values).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    # the values go straight into queries, so only a flat document of plain values is accepted,
+    # a nested one could smuggle in query operators
+    try:
+        last_values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(last_values, dict) or any(isinstance(value, (dict, list)) for value in last_values.values()):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return last_values
+
+
+def cursor_from_row(row, sort_option):
+    return encode_cursor({field: row.get(field) for field in sort_option})
+
+
+def seek_filter(sort_option, last_values):
+    # matches the rows that come after last_values in the order of sort_option.
+    # the sort has to end on a unique field (_id), null and missing values sort lowest
+    fields = list(sort_option)
+    conditions = []
+    for i, field in enumerate(fields):
+        value = last_values.get(field)
+        if sort_option[field] == 1:
+            after = {field: {"$ne": None}} if value is None else {
+                field: {"$gt": value}}
+        elif value is None:
+            # nothing sorts after null in a descending sort
+            continue
+        else:
+            after = {"$or": [{field: {"$lt": value}}, {field: None}]}
+        conditions.append({**{earlier: last_values.get(earlier)
+                          for earlier in fields[:i]}, **after})
+    return {"$or": conditions} if conditions else {"_id": {"$exists": False}}
+
+
+async def find_page(collection, query: dict, sort_option: dict, cursor: str = None, limit: int = 20, projection: dict = None):
+    # one page of the query in the order of sort_option, after the row the cursor points at.
+    # returns the rows with string ids and the cursor of the next page, None on the last one
+    if limit < 1:
+        raise ValueError("limit must be at least 1")
+    if cursor:
+        query = {"$and": [query, seek_filter(sort_option, decode_cursor(cursor))]}
+    rows = await collection.find(query, projection).sort(list(sort_option.items())).limit(limit + 1).to_list(limit + 1)
+    next_cursor = cursor_from_row(rows[limit - 1], sort_option) if len(rows) > limit else None
+    rows = rows[:limit]
+    for row in rows:
+        row["_id"] = str(row["_id"])
+    return rows, next_cursor
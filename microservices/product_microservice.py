@@ -1,36 +1,96 @@
+import hashlib
+import os
 import random
+import re
 import time
 from typing import List
+from microservices.cache_microservice import TTLCache
+from microservices.search_microservice import ensure_search_index, search_index
 from mongomanager import product_collection
-from rapidfuzz import process, utils
+
+
+# the fields of a product shown on a listing card, for aggregation $project stages.
+# /products/fetch-product and fetch-products are the only endpoints that return whole documents
+PRODUCT_CARD_PROJECTION = {
+    "name": 1,
+    "price": 1,
+    # the card sized version of the first image, or the original for older products
+    "images": {"$let": {
+        "vars": {"first": {"$arrayElemAt": ["$image_variants", 0]}},
+        "in": {"$cond": [{"$ifNull": ["$$first.card", False]}, ["$$first.card"], {"$slice": ["$images", 1]}]},
+    }},
+    "average_rating": 1,
+    "rating_count": 1,
+}
+
+
+# id -> whole product document for fetch-product(s). writes through this worker drop the
+# entry, other workers see them once it expires
+product_cache = TTLCache(maxsize=int(os.getenv("PRODUCT_CACHE_SIZE", 5000)),
+                         ttl=float(os.getenv("PRODUCT_CACHE_SECONDS", 60)))
+
+
+def invalidate_product(id):
+    product_cache.pop(str(id))
 
 
 def generate_key():
     return str(int(time.time() * 1000)) + "_" + str(random.randint(100000000, 999999999))
 
 
+def is_generated_key(key: str):
+    # keys sent back by clients after a direct upload must be ones generate_key could have made
+    return re.fullmatch(r"\d+_\d{9}", key) is not None
+
+
+def generate_content_key(digest: str):
+    # images are stored under their content hash, the same image is only stored once
+    return "sha256_" + digest
+
+
+def digest_from_key(key: str):
+    return key.split("_")[1] if key.startswith("sha256_") else None
+
+
+def hash_file(file, chunk_size=1024 * 1024):
+    # sha256 of a file read in chunks, so a large upload is never held in memory whole
+    digest = hashlib.sha256()
+    file.seek(0)
+    while chunk := file.read(chunk_size):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+async def match_products_from_tags(tags: List[str]):
+    # ids of every product that fits one of the tags
+    await ensure_search_index()
+    return list(search_index.match_tags(tags))
+
+
 async def get_products_from_tags(tags: List[str]):
     # this function gets a list of tags and hands out products that fit these tags
     try:
-        all_products = await product_collection.find({}, {"_id": 1, "tags": 1}).to_list(None)
-        matching_ids = []
-        for product in all_products:
-            for tag_string in tags:
-                product_score = process.extractOne(
-                    tag_string, [tag for tag in product["tags"]], processor=utils.default_process)
-                if product_score[2] <= 1 and product_score[1] >= 80:
-                    matching_ids.append(product["_id"])
+        matching_ids = await match_products_from_tags(tags)
         if len(matching_ids) < 4:
             return []
-        products = await product_collection.find({"_id": {"$in": matching_ids}}).to_list(None)
-        # fetch 4 random products.
-        if len(matching_ids) >= 4:
-            products_to_send = random.sample(products, 4)
-            # convert id to string because of python
-            for product in products_to_send:
-                product["_id"] = str(product["_id"])
-            return products_to_send
-        return []
+        # fetch 4 random products, only those 4 are read from the db.
+        remaining_ids = random.sample(matching_ids, len(matching_ids))
+        products_to_send = []
+        # the index can briefly lag the db, keep drawing until 4 products are found
+        while remaining_ids and len(products_to_send) < 4:
+            missing = 4 - len(products_to_send)
+            products_to_send += await product_collection.aggregate([
+                {"$match": {"_id": {"$in": remaining_ids[:missing]}}},
+                {"$project": PRODUCT_CARD_PROJECTION},
+            ]).to_list(None)
+            remaining_ids = remaining_ids[missing:]
+        if len(products_to_send) < 4:
+            return []
+        # convert id to string because of python
+        for product in products_to_send:
+            product["_id"] = str(product["_id"])
+        return products_to_send
     except Exception as e:
         print(str(e), " failed to get products from tags")
         return []
@@ -0,0 +1,72 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from botocore.exceptions import ClientError
+from schemas.product_schemas import BUCKET_NAME, BUCKET_URL, s3
+
+# boto3 blocks, so its calls run on this pool, which also caps how many run at once
+S3_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 4))
+_s3_pool = ThreadPoolExecutor(max_workers=S3_CONCURRENCY,
+                              thread_name_prefix="s3")
+# images uploaded straight from the client: how long the presigned urls work and the largest size accepted
+PRESIGNED_URL_SECONDS = int(os.getenv("S3_PRESIGNED_URL_SECONDS", 600))
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+
+
+def object_url(key: str):
+    return f"{BUCKET_URL}/{key}"
+
+
+def key_from_url(url: str):
+    return url[len(BUCKET_URL) + 1:]
+
+
+async def run_s3(function, *args, **kwargs):
+    # runs a blocking boto3 call without stalling the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_s3_pool, partial(function, *args, **kwargs))
+
+
+async def upload_image(image, key: str):
+    # boto3 reads the spooled upload in chunks, it is never copied into memory whole
+    await image.seek(0)
+    extra_args = {"ContentType": image.content_type} if image.content_type else None
+    await run_s3(s3.upload_fileobj, image.file, BUCKET_NAME, key, ExtraArgs=extra_args)
+    return key
+
+
+async def upload_bytes(data: bytes, key: str, content_type: str):
+    await run_s3(s3.put_object, Bucket=BUCKET_NAME, Key=key, Body=data, ContentType=content_type)
+    return key
+
+
+async def delete_keys(keys):
+    if keys:
+        await run_s3(s3.delete_objects, Bucket=BUCKET_NAME,
+                     Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+
+
+def presign_upload(key: str, content_type: str):
+    # signing happens locally, no request is made to S3. the POST form also enforces the size,
+    # a PUT can't, so the size is checked again when the product is uploaded
+    post = s3.generate_presigned_post(
+        BUCKET_NAME, key,
+        Fields={"Content-Type": content_type},
+        Conditions=[{"Content-Type": content_type},
+                    ["content-length-range", 1, MAX_IMAGE_BYTES]],
+        ExpiresIn=PRESIGNED_URL_SECONDS)
+    put_url = s3.generate_presigned_url(
+        "put_object", Params={"Bucket": BUCKET_NAME, "Key": key, "ContentType": content_type},
+        ExpiresIn=PRESIGNED_URL_SECONDS)
+    return {"key": key, "url": object_url(key), "post": post, "put": put_url}
+
+
+async def head_key(key: str):
+    # metadata of an uploaded object, None if nothing was uploaded under the key
+    try:
+        return await run_s3(s3.head_object, Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
@@ -0,0 +1,217 @@
+import asyncio
+from datetime import datetime, timezone
+import numpy as np
+from rapidfuzz import utils
+from microservices.fuzzy_microservice import flatten_terms, max_per_product, score_terms
+from mongomanager import product_collection
+
+# a product needs a score above this to count as a search match
+SEARCH_SCORE_THRESHOLD = 85
+# a product tag needs at least this score to match a recommendation tag
+TAG_SCORE_THRESHOLD = 80
+# the product fields the index is built from
+INDEXED_FIELDS = {"_id": 1, "name": 1, "tags": 1, "category": 1}
+
+
+def product_search_terms(product):
+    # the words a product is searched by: name words, category and tags
+    return [word for word in product["name"].split() if len(word) > 2] + [product["category"]] + [tag for tag in product["tags"] if len(tag) > 1]
+
+
+def term_bigrams(term):
+    # bigrams of every token padded with spaces. every string the scorer builds out of
+    # the tokens (sorted, intersected or a substring) only holds these bigrams, so a
+    # term that shares none with the query can't score above the threshold
+    bigrams = set()
+    for token in term.split():
+        padded = f" {token} "
+        bigrams.update(padded[i:i + 2] for i in range(len(padded) - 1))
+    return bigrams
+
+
+class SearchIndex:
+    # inverted index over the search terms of every product, kept in memory so a
+    # search only scores the distinct terms that could match instead of every product
+    def __init__(self):
+        self.generation = 0  # bumped on every change, keeps counting across rebuilds
+        self.loaded_at = None  # when the products of the last rebuild were read
+        self.clear()
+
+    def clear(self):
+        self.ready = False
+        self.products = {}  # product id -> {"category": str, "terms": [term ids], "tags": [tag ids]}
+        self.terms = []  # term id -> processed term
+        self.term_ids = {}  # processed term -> term id
+        self.postings = []  # term id -> set of product ids
+        self.bigrams = {}  # bigram -> set of term ids
+        self.short_terms = set()  # single character terms, they have no bigram to index
+        self.tags = []  # tag id -> processed product tag
+        self.tag_ids = {}  # processed product tag -> tag id
+        self.lead_postings = []  # tag id -> product ids having it as one of their first two tags
+        self._removed = 0  # removals since the vocabulary was last compacted
+        self._compiled = None  # flat numpy layout of self.products, see _compile
+
+    def rebuild(self, products, loaded_at=None):
+        self.clear()
+        for product in products:
+            try:
+                self.upsert_product(product)
+            except Exception as e:
+                print(f"Error indexing product {product.get('_id')}: {e}")
+        self.loaded_at = loaded_at
+        self.ready = True
+
+    def upsert_product(self, product):
+        # adds a product or replaces the indexed fields of an existing one. False if they
+        # are already indexed as they are, the index and its generation are then left alone
+        terms = [utils.default_process(term)
+                 for term in product_search_terms(product)]
+        tags = [utils.default_process(tag) for tag in product["tags"]]
+        entry = self.products.get(product["_id"])
+        if entry is not None and entry["category"] == product["category"] \
+                and [self.terms[term_id] for term_id in entry["terms"]] == terms \
+                and [self.tags[tag_id] for tag_id in entry["tags"]] == tags:
+            return False
+        self.remove_product(product["_id"])
+        self._add(product["_id"], product["category"], terms, tags)
+        return True
+
+    def remove_product(self, product_id):
+        entry = self.products.pop(product_id, None)
+        if entry is None:
+            return False
+        for term_id in entry["terms"]:
+            self.postings[term_id].discard(product_id)
+        for tag_id in entry["tags"][:2]:
+            self.lead_postings[tag_id].discard(product_id)
+        self.generation += 1
+        self._compiled = None
+        self._removed += 1
+        # terms of removed products stay in the vocabulary until it is compacted
+        if self._removed > max(1000, len(self.products)):
+            self._compact()
+        return True
+
+    def _add(self, product_id, category, terms, tags):
+        term_ids = [self._term_id(term) for term in terms]
+        tag_ids = [self._tag_id(tag) for tag in tags]
+        self.products[product_id] = {
+            "category": category, "terms": term_ids, "tags": tag_ids}
+        for term_id in term_ids:
+            self.postings[term_id].add(product_id)
+        for tag_id in tag_ids[:2]:
+            self.lead_postings[tag_id].add(product_id)
+        self.generation += 1
+        self._compiled = None
+
+    def _compact(self):
+        # rebuilds the vocabulary from the indexed products, dropping unused terms and tags
+        products = [(product_id, entry["category"], [self.terms[term_id] for term_id in entry["terms"]],
+                     [self.tags[tag_id] for tag_id in entry["tags"]])
+                    for product_id, entry in self.products.items()]
+        generation, ready = self.generation, self.ready
+        self.clear()
+        for product in products:
+            self._add(*product)
+        self.generation, self.ready = generation + 1, ready
+
+    def _term_id(self, term):
+        if term in self.term_ids:
+            return self.term_ids[term]
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.term_ids[term] = term_id
+        self.postings.append(set())
+        if len(term) < 2:
+            self.short_terms.add(term_id)
+        for bigram in term_bigrams(term):
+            self.bigrams.setdefault(bigram, set()).add(term_id)
+        return term_id
+
+    def _tag_id(self, tag):
+        if tag in self.tag_ids:
+            return self.tag_ids[tag]
+        tag_id = len(self.tags)
+        self.tags.append(tag)
+        self.tag_ids[tag] = tag_id
+        self.lead_postings.append(set())
+        return tag_id
+
+    def candidate_terms(self, search):
+        processed = utils.default_process(search)
+        # a one character query can match any term containing that character
+        if len(processed) < 2:
+            return set(range(len(self.terms)))
+        candidates = set(self.short_terms)
+        for bigram in term_bigrams(processed):
+            candidates |= self.bigrams.get(bigram, set())
+        return candidates
+
+    def _compile(self):
+        # the products as flat numpy arrays so a search is scored in a few vectorized calls
+        if self._compiled is None:
+            products = list(self.products.items())
+            flat, offsets, counts = flatten_terms(
+                [entry["terms"] for _, entry in products])
+            self._compiled = {
+                "product_ids": [product_id for product_id, _ in products],
+                "categories": np.array([entry["category"] for _, entry in products], dtype=object),
+                "flat": flat,
+                "offsets": offsets,
+                "counts": counts,
+            }
+        return self._compiled
+
+    def search(self, search, category=None):
+        # returns the best score of every product scoring above the threshold
+        compiled = self._compile()
+        candidates = np.fromiter(self.candidate_terms(search), dtype=np.int64)
+        term_scores = np.zeros((1, len(self.terms)))
+        term_scores[:, candidates] = score_terms(
+            [search], [self.terms[term_id] for term_id in candidates])
+        best = max_per_product(
+            term_scores, compiled["flat"], compiled["offsets"], compiled["counts"])[0]
+        matched = best > SEARCH_SCORE_THRESHOLD
+        if category:
+            matched &= compiled["categories"] == category
+        return {compiled["product_ids"][i]: float(best[i]) for i in np.flatnonzero(matched)}
+
+    def match_tags(self, tags):
+        # a product matches a tag when its best scoring tag is one of its first two and
+        # reaches the threshold. every tag is scored once against the distinct product tags
+        # and only the products listed under a matching lead tag are checked
+        tag_scores = score_terms(tags, self.tags)
+        matched = set()
+        for row in tag_scores:
+            for tag_id in np.flatnonzero(row >= TAG_SCORE_THRESHOLD):
+                for product_id in self.lead_postings[tag_id] - matched:
+                    tag_ids = self.products[product_id]["tags"]
+                    if row[tag_ids[:2]].max() >= row[tag_ids].max():
+                        matched.add(product_id)
+        return matched
+
+
+search_index = SearchIndex()
+_build_lock = asyncio.Lock()
+
+
+async def _load_search_index():
+    loaded_at = datetime.now(timezone.utc)
+    products = await product_collection.find({}, INDEXED_FIELDS).to_list(None)
+    search_index.rebuild(products, loaded_at)
+    print(f"Search index built with {len(search_index.products)} products")
+
+
+async def build_search_index():
+    # loads the searchable fields of every product and replaces the index
+    async with _build_lock:
+        await _load_search_index()
+
+
+async def ensure_search_index():
+    # builds the index on first use if it wasn't built at startup
+    if search_index.ready:
+        return
+    async with _build_lock:
+        if not search_index.ready:
+            await _load_search_index()
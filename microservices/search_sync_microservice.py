@@ -0,0 +1,164 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from bson import Timestamp
+from pymongo.errors import OperationFailure
+from microservices.search_microservice import INDEXED_FIELDS, build_search_index, ensure_search_index, search_index
+from mongomanager import product_collection
+
+# seconds between polls when change streams are not available
+POLL_INTERVAL = float(os.getenv("SEARCH_INDEX_POLL_SECONDS", 5))
+# every this many polls the indexed ids are compared with the db to find deleted products
+RECONCILE_EVERY_POLLS = int(os.getenv("SEARCH_INDEX_RECONCILE_POLLS", 12))
+# how far back changes are replayed to cover clock differences between servers
+CLOCK_SKEW_SECONDS = 5
+# change streams need a replica set, a standalone mongod answers with this code
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+sync_state = {
+    "mode": None,  # "change_stream" or "polling"
+    "events_applied": 0,
+    "last_event_at": None,  # server time of the last applied change
+    "last_synced_at": None,  # when the index was last known to be up to date
+}
+_sync_task = None
+
+
+def apply_product_change(change):
+    # applies one change stream event to the index. a product that can't be indexed is
+    # logged and skipped, it is picked up again by its next change or rebuild
+    operation = change["operationType"]
+    try:
+        if operation == "delete":
+            search_index.remove_product(change["documentKey"]["_id"])
+        elif operation in ("insert", "update", "replace") and change.get("fullDocument"):
+            search_index.upsert_product(change["fullDocument"])
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            return False
+    except Exception as e:
+        print(f"Error indexing product {change.get('documentKey')}: {e}")
+        return True
+    sync_state["events_applied"] += 1
+    sync_state["last_event_at"] = datetime.fromtimestamp(
+        change["clusterTime"].time, timezone.utc)
+    sync_state["last_synced_at"] = datetime.now(timezone.utc)
+    return True
+
+
+def _resume_time():
+    # changes are replayed from a little before the index was loaded, applying one twice is harmless
+    loaded_at = search_index.loaded_at or datetime.now(timezone.utc)
+    return loaded_at - timedelta(seconds=CLOCK_SKEW_SECONDS)
+
+
+async def watch_product_changes():
+    # follows the Products change stream, only the indexed fields of the document are sent
+    pipeline = [{"$project": {
+        "operationType": 1, "documentKey": 1, "clusterTime": 1,
+        **{f"fullDocument.{field}": 1 for field in INDEXED_FIELDS}}}]
+    start_at = Timestamp(_resume_time(), 0)
+    async with product_collection.watch(pipeline, full_document="updateLookup", start_at_operation_time=start_at) as stream:
+        sync_state["mode"] = "change_stream"
+        print("Search index following product change stream")
+        while stream.alive:
+            change = await stream.try_next()
+            if change is None:
+                # no changes waiting, the index is up to date
+                sync_state["last_synced_at"] = datetime.now(timezone.utc)
+            elif not apply_product_change(change):
+                # the collection itself changed, start over from a full rebuild
+                return
+
+
+async def poll_product_changes():
+    # fallback for deployments without change streams. new products are found by _id and
+    # changed ones by updated_at, deletions by comparing ids every few polls
+    sync_state["mode"] = "polling"
+    print("Search index polling for product changes")
+    last_id = max(search_index.products, default=None)
+    last_updated = _resume_time()
+    polls = 0
+    while True:
+        polled_at = datetime.now(timezone.utc)
+        query = {"updated_at": {"$gte": last_updated}}
+        if last_id is not None:
+            query = {"$or": [{"_id": {"$gt": last_id}}, query]}
+        changed = await product_collection.find(query, {**INDEXED_FIELDS, "updated_at": 1}).to_list(None)
+        applied = 0
+        for product in changed:
+            # products inside the replayed window come back on every poll, unchanged
+            # ones leave the index as it is and aren't counted
+            try:
+                applied += search_index.upsert_product(product)
+            except Exception as e:
+                print(f"Error indexing product {product.get('_id')}: {e}")
+            last_id = product["_id"] if last_id is None else max(
+                last_id, product["_id"])
+            if product.get("updated_at"):
+                last_updated = max(last_updated, product["updated_at"].replace(
+                    tzinfo=timezone.utc) - timedelta(seconds=CLOCK_SKEW_SECONDS))
+        polls += 1
+        if polls % RECONCILE_EVERY_POLLS == 0:
+            existing_ids = set(await product_collection.distinct("_id"))
+            for product_id in set(search_index.products) - existing_ids:
+                search_index.remove_product(product_id)
+        sync_state["events_applied"] += applied
+        sync_state["last_synced_at"] = polled_at
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def sync_search_index():
+    # keeps the index current for the lifetime of the server
+    rebuild = False
+    while True:
+        try:
+            if rebuild:
+                await build_search_index()
+            else:
+                await ensure_search_index()
+            try:
+                await watch_product_changes()
+            except (OperationFailure, NotImplementedError) as e:
+                if isinstance(e, OperationFailure) and e.code != CHANGE_STREAM_NOT_SUPPORTED:
+                    raise
+                await poll_product_changes()
+        except Exception as e:
+            # anything unexpected restarts the sync instead of ending it for good
+            print(str(e), "search index sync failed, retrying")
+            await asyncio.sleep(POLL_INTERVAL)
+        # changes may have been missed, continue from a fresh index
+        rebuild = True
+
+
+def start_search_index_sync():
+    global _sync_task
+    if _sync_task is None:
+        _sync_task = asyncio.create_task(sync_search_index())
+
+
+async def stop_search_index_sync():
+    global _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        try:
+            await _sync_task
+        except asyncio.CancelledError:
+            pass
+        _sync_task = None
+
+
+def search_index_stats():
+    now = datetime.now(timezone.utc)
+    last_synced_at = sync_state["last_synced_at"]
+    return {
+        "generation": search_index.generation,
+        "ready": search_index.ready,
+        "products": len(search_index.products),
+        "terms": len(search_index.terms),
+        "tags": len(search_index.tags),
+        "mode": sync_state["mode"],
+        "events_applied": sync_state["events_applied"],
+        "last_event_at": sync_state["last_event_at"],
+        "last_synced_at": last_synced_at,
+        "lag_seconds": (now - last_synced_at).total_seconds() if last_synced_at else None,
+    }
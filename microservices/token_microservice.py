@@ -0,0 +1,56 @@
+from datetime import timedelta
+import os
+import time
+import jwt
+from microservices.cache_microservice import TTLCache
+
+ACCESS_TOKEN_LIFETIME = timedelta(
+    minutes=float(os.getenv("ACCESS_TOKEN_MINUTES", 15)))
+# while an access token minted from a refresh token has at least this share of its lifetime
+# left, refreshing again with the same refresh token returns it instead of a new one
+ACCESS_TOKEN_REUSE_SHARE = 0.5
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+
+_secrets = {}
+# token -> verified claims, kept until the token expires
+verified_claims = TTLCache(maxsize=TOKEN_CACHE_SIZE,
+                           ttl=ACCESS_TOKEN_LIFETIME.total_seconds())
+# refresh token -> the access token last minted from it
+issued_access_tokens = TTLCache(maxsize=TOKEN_CACHE_SIZE,
+                                ttl=ACCESS_TOKEN_LIFETIME.total_seconds() * ACCESS_TOKEN_REUSE_SHARE)
+
+
+def get_secret(name: str):
+    # the signing keys are read from the environment once per process
+    if name not in _secrets:
+        _secrets[name] = os.getenv(name)
+    return _secrets[name]
+
+
+def encode_token(claims: dict, secret_name: str):
+    return jwt.encode(claims, get_secret(secret_name), algorithm="HS256")
+
+
+def decode_token(token, secret_name: str):
+    # verified claims of the token, raises jwt.InvalidTokenError if it is invalid or expired.
+    # a token seen before is only checked against its expiry
+    if not token:
+        raise jwt.InvalidTokenError("No token")
+    if isinstance(token, bytes):
+        token = token.decode()
+    claims = verified_claims.get((secret_name, token))
+    if claims is not None:
+        return claims
+    claims = jwt.decode(token, get_secret(secret_name), algorithms="HS256")
+    if "exp" in claims:
+        verified_claims.set((secret_name, token), claims,
+                            ttl=claims["exp"] - time.time())
+    return claims
+
+
+def decode_access_token(token):
+    return decode_token(token, "JWT_SECRET_ACCESS")
+
+
+def decode_refresh_token(token):
+    return decode_token(token, "JWT_SECRET_REFRESH")
@@ -1,7 +1,29 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 import bcrypt
+from bson import ObjectId
 from fastapi import HTTPException
+from microservices.cache_microservice import TTLCache
 from mongomanager import users_collection
 
+# bcrypt work factor of new hashes, stored hashes of another cost are redone on the next signin
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt releases the GIL, so hashing runs on threads and never blocks the event loop.
+# at most PASSWORD_WORKERS hashes run at once and PASSWORD_QUEUE_LIMIT more may wait,
+# past that requests are turned away with a 503 instead of piling up
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", os.cpu_count() or 1))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", 32))
+_password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                    thread_name_prefix="bcrypt")
+_password_jobs = 0
+
+# the user fields /user/fetch-user returns
+USER_PROFILE_PROJECTION = {"email": 1, "verified": 1, "name": 1, "address": 1}
+# email -> profile. writes through this worker drop the entry, other workers see them within the ttl
+profile_cache = TTLCache(maxsize=int(os.getenv("PROFILE_CACHE_SIZE", 10000)),
+                         ttl=float(os.getenv("PROFILE_CACHE_SECONDS", 60)))
+
 
 async def find_user_by_email(email: str):
     user = await users_collection.find_one({'email': email})
@@ -10,19 +32,79 @@ async def find_user_by_email(email: str):
     return user
 
 
-def hash_password(password: str) -> str:
-    encrypt = bcrypt.gensalt()
+async def run_password_job(function, *args):
+    global _password_jobs
+    if _password_jobs >= PASSWORD_WORKERS + PASSWORD_QUEUE_LIMIT:
+        raise HTTPException(status_code=503, detail="Server busy, try again shortly",
+                            headers={"Retry-After": "1"})
+    _password_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_password_pool, function, *args)
+    finally:
+        _password_jobs -= 1
+
+
+async def get_user_profile(email: str):
+    profile = profile_cache.get(email)
+    if profile is None:
+        result = await users_collection.find_one({"email": email}, USER_PROFILE_PROJECTION)
+        if result is None:
+            return None
+        profile = {
+            "_id": str(result["_id"]),
+            "email": result["email"],
+            "verified": result["verified"],
+            "name": result["name"],
+            "address": result["address"]
+        }
+        profile_cache.set(email, profile)
+    return dict(profile)
+
+
+def invalidate_user_profile(email: str):
+    profile_cache.pop(email)
+
+
+def _hash_password(password: str) -> str:
+    encrypt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), encrypt)
     return hashed.decode('utf-8')
 
 
-def compare_passwords(password: str, hashed: str):
-    if bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8')):
+def _check_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+async def hash_password(password: str) -> str:
+    return await run_password_job(_hash_password, password)
+
+
+async def compare_passwords(password: str, hashed: str):
+    if await run_password_job(_check_password, password, hashed):
         return True
     else:
         raise HTTPException(status_code=404, detail="User Not Found")
 
 
+def needs_rehash(hashed: str):
+    # bcrypt hashes look like $2b$<cost>$<salt and hash>
+    try:
+        return int(hashed.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+async def rehash_password(user_id: str, password: str, hashed: str):
+    # moves a stored hash to the current cost, unless the password changed meanwhile
+    try:
+        new_hash = await hash_password(password)
+        await users_collection.update_one({"_id": ObjectId(user_id), "password": hashed},
+                                          {"$set": {"password": new_hash}})
+    except Exception as e:
+        print(f"Error rehashing password {e}")
+
+
 async def save_user(user_data):
     try:
         await users_collection.insert_one(user_data)
@@ -12,3 +12,5 @@ orders_collection = db.get_collection("Orders")
 user_visited_collection = db.get_collection("User_Last_Visited")
 order_history_collection = db.get_collection("User_Order_History")
 user_search_history_collection = db.get_collection("User_Search_History")
+image_hash_collection = db.get_collection("Image_Hashes")
+image_upload_collection = db.get_collection("Image_Uploads")
@@ -1,6 +1,7 @@
-from fastapi import APIRouter, BackgroundTasks, Request
+from fastapi import APIRouter, Request
 from schemas.user_schemas import EmailSchema, VerificationCodeSchema
 from services.auth_service import *
+from microservices.mail_microservice import mailer
 
 router = APIRouter(prefix="/auth")
 
@@ -32,8 +33,8 @@ def verify_access_token(access_token: str):
 
 @router.post("/get-verification-code")
 # function that sends a random verification code via email and saves it on temp db
-async def validate_email(background_tasks: BackgroundTasks, email_data: EmailSchema):
-    result = await get_verification_code(background_tasks, email_data.email)
+async def validate_email(email_data: EmailSchema):
+    result = await get_verification_code(email_data.email)
     if result:
         return {"status": "success", "message": "Verification email sent."}
 
@@ -43,3 +44,9 @@ async def validate_email(background_tasks: BackgroundTasks, email_data: EmailSch
 async def validate_code(validation_data: VerificationCodeSchema):
     result = await verify_verification_code(validation_data)
     return result
+
+
+@router.get("/mailer-stats")
+async def get_mailer_stats():
+    # queue depth, connections and send latency of this worker's mailer
+    return {"status": "success", "stats": mailer.stats()}
@@ -2,7 +2,7 @@ from fastapi import APIRouter, HTTPException
 
 from schemas.cart_schemas import MutateCartSchema, SaveLocalCart
 from schemas.user_schemas import GetUserDataSchema
-from services.cart_service import update_cart_from_local, get_user_cart, add_to_cart, delete_item_in_cart
+from services.cart_service import update_cart_from_local, get_user_cart, hydrate_cart, add_to_cart, delete_item_in_cart
 
 router = APIRouter(prefix="/cart")
 
@@ -11,15 +11,18 @@ router = APIRouter(prefix="/cart")
 async def save_local_cart(request: SaveLocalCart):
     # this function saves the cart that a user had before logged,2 in the db
     result = await update_cart_from_local(request)
-    if result.modified_count:
+    if result:
         return {"status": "success", "message": "Items added successfuly."}
     return {"status": "failiure", "message": "Items were not added"}
 
 
 @router.post("/get-cart")
-async def get_cart(user_data: GetUserDataSchema):
-    # get cart from user db
+async def get_cart(user_data: GetUserDataSchema, hydrate: bool = False):
+    # get cart from user db. hydrate=true returns each line with its product card and
+    # line total, plus the ids of products that no longer exist
     cart = await get_user_cart(user_data)
+    if hydrate:
+        return {"status": "success", **await hydrate_cart(cart)}
     return {"status": "success", "cart": cart}
 
 
@@ -1,7 +1,8 @@
-from fastapi import APIRouter, HTTPException
-from schemas.orders_schemas import DeleteOrderSchema, OrderSchema
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query
+from schemas.orders_schemas import CheckoutSchema, DeleteOrderSchema, OrderSchema
 from schemas.user_schemas import GetUserDataSchema
-from services.orders_service import upload_orders, update_cart, fetch_orders, delete_orders
+from services.orders_service import MAX_ORDERS_PAGE, upload_orders, update_cart, checkout, fetch_orders, delete_orders
 
 router = APIRouter(prefix="/orders")
 
@@ -24,12 +25,22 @@ async def upload_order(order: OrderSchema):
         raise HTTPException(status_code=400, detail="Unable to complete order")
 
 
+@router.post("/checkout")
+async def checkout_cart(data: CheckoutSchema):
+    # orders every item of the cart in one go, each line reports its own result
+    results = await checkout(data)
+    ordered = sum(result["status"] == "success" for result in results)
+    status = "success" if ordered == len(results) else "partial" if ordered else "failure"
+    return {"status": status, "results": results}
+
+
 @router.post("/fetch-orders")
-async def fetch_order(data: GetUserDataSchema):
-    # get orders from user
-    orders = await fetch_orders(data)
+async def fetch_order(data: GetUserDataSchema, cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=MAX_ORDERS_PAGE)):
+    # get a page of orders from user, send back nextCursor for the next page
+    orders = await fetch_orders(data, cursor, limit)
     if orders:
-        return {"status": "success", "orders": orders["orders"]}
+        orders, next_cursor = orders
+        return {"status": "success", "orders": orders, "nextCursor": next_cursor}
     print("failed to fetch orders")
     raise HTTPException(status_code=400, detail="Bad Request")
 
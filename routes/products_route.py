@@ -1,16 +1,30 @@
 import json
 from typing import List, Optional
-from fastapi import APIRouter, File, Form, Query, UploadFile
+from bson import ObjectId
+from fastapi import APIRouter, File, Form, HTTPException, Query, UploadFile
 from services.products_service import *
 from services.users_service import check_if_user_valid
-from schemas.product_schemas import ProductSchema, ProductsFromTagsSchema
+from microservices.pagination_microservice import cursor_from_row, decode_cursor, encode_cursor, seek_filter
+from microservices.search_sync_microservice import search_index_stats
+from schemas.product_schemas import CategoryProductsResponse, FetchProductsSchema, ImageUploadUrlsSchema, ProductListingResponse, ProductSchema, ProductsFromTagsResponse, ProductsFromTagsSchema
 
 
 router = APIRouter(prefix="/products")
 
 
+@router.post("/image-upload-urls")
+# presigned urls for uploading product images straight to aws, their keys are then sent to upload-product
+async def get_image_upload_urls(data: ImageUploadUrlsSchema):
+    if (not await check_if_user_valid(data.seller)):
+        return {"ERROR": "User not validated"}
+    if not all(content_type.startswith("image/") for content_type in data.content_types):
+        return {"status": "failure", "message": "Only images can be uploaded"}
+    return {"status": "success", "uploads": await create_image_upload_urls(data.seller, data.content_types)}
+
+
 @router.post("/upload-product")
-# uploads product to db and images to aws cloud
+# uploads product to db and images to aws cloud. images already uploaded with
+# presigned urls are sent as a json list of their keys in image_keys instead
 async def upload_product(
     seller: str = Form(...),
     name: str = Form(...),
@@ -18,7 +32,8 @@ async def upload_product(
     details: str = Form(...),
     tags: str = Form(...),
     price: float = Form(...),
-    images: List[UploadFile] = File(...),
+    images: List[UploadFile] = File(None),
+    image_keys: Optional[str] = Form(None),
 ):
     tag_values = json.loads(tags)
     product = ProductSchema(
@@ -28,22 +43,29 @@ async def upload_product(
         details=details,
         tags=tag_values,
         price=price,
-        images=images,
+        images=images or [],
     )
     # holds the urls to be saved in the db with the product
     if (not await check_if_user_valid(seller)):
         return {"ERROR": "User not validated"}
-    image_urls = await images_to_links(product.images)
-    if not image_urls:
+    if image_keys:
+        uploaded_images = await verify_uploaded_keys(json.loads(image_keys), seller)
+    else:
+        uploaded_images = await images_to_links(product.images)
+    if not uploaded_images:
         return {"status": "failure", "message": f"Error uploading image"}
     else:
-        product.images = image_urls
+        # images keeps the original urls, the resized versions are listed per image
+        product.images = [image["original"] for image in uploaded_images]
+        product.image_variants = uploaded_images
     if (await upload_product_db(product)):
+        await remember_uploaded_images(uploaded_images)
         return {"status": "success", "message": "Product uploaded successfully."}
+    await delete_uploaded_images([url for image in uploaded_images for url in image.values()])
     return {"status": "failure", "message": "Error uploading product"}
 
 
-@router.get("/query-products-by-category")
+@router.get("/query-products-by-category", response_model=CategoryProductsResponse)
 async def query_products_by_category(category: str, number: int):
     # get a specific amount of different products from based on their category
     result = await query_product_by_category(category, number)
@@ -59,27 +81,64 @@ async def fetch_product(id: str):
     return {"status": "failure", "error": "Unable to query product"}
 
 
-@router.get("/products-query")
-async def get_products(category: Optional[str] = None, search: Optional[str] = None, page: int = Query(1), per_page: int = 8, sort_by: Optional[str] = None, rnd: Optional[bool] = False):
+@router.post("/fetch-products")
+async def fetch_products(data: FetchProductsSchema):
+    # fetch many products at once, in the order of the ids. ids not found are listed in missing
+    products, missing = await get_products_by_ids(data.ids, data.fields)
+    return {"status": "success", "products": products, "missing": missing}
+
+
+@router.get("/products-query", response_model=ProductListingResponse)
+async def get_products(category: Optional[str] = None, search: Optional[str] = None, page: int = Query(1), per_page: int = 8, sort_by: Optional[str] = None, rnd: Optional[bool] = False, search_token: Optional[str] = None, cursor: Optional[str] = None):
     # this function is being used with infinite scrolling of react query.
-    # create a search query based on category or tags or name
-    query, relevance_map = await get_search_query(search, rnd, category)
-    total_products = await get_relevant_products(query)
     # using the page, decide on how many products to skip over that were already fetched
     skip_count = (page - 1) * per_page
     # if sort by relevence, keep the order the same
     sort_option = get_sort_option(sort_by, search)
+    if search and not rnd:
+        # the search is matched and ranked once, later pages send back the token to reuse it.
+        # a cursor of a search page holds the token and the position of the next page
+        if cursor:
+            position = decode_cursor(cursor)
+            search_token, skip_count = position.get("searchToken"), position.get("offset")
+            if not isinstance(search_token, str) or not isinstance(skip_count, int) or skip_count < 0:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        session = await get_search_session(search_token, search, category, sort_option)
+        products = await get_search_page(session, skip_count, per_page)
+        total_products = len(session["ids"])
+        has_more = skip_count + per_page < total_products
+        next_page = page + 1 if has_more else None
+        next_cursor = encode_cursor({"searchToken": session["token"], "offset": skip_count + per_page}) if has_more else None
+        return {"products": products, "nextPage": next_page, "nextCursor": next_cursor, "length": total_products,
+                "searchToken": session["token"]}
+    # create a search query based on category or tags or name
+    query, relevance_map = await get_search_query(search, rnd, category)
+    # a cursor from the previous page seeks past its last product instead of skipping pages
+    seek = None
+    if cursor:
+        seek = seek_filter(sort_option, decode_cursor(cursor))
+        skip_count = 0
     # pipeline for custom searching the average ratings and by relevency:
-    pipeline = await build_product_query_pipeline(query, relevance_map, sort_option, skip_count, per_page)
-    products = await product_pipeline(pipeline, per_page)
+    # one extra product is fetched to know if there is a next page
+    products, total_products = await get_products_page(query, relevance_map, sort_option, skip_count, per_page + 1, seek)
+    has_more = len(products) > per_page
+    products = products[:per_page]
     # ( if theres no products left)
-    next_page = page + 1 if skip_count + per_page < total_products else None
-    return {"products": products, "nextPage": next_page, "length": total_products}
+    next_page = page + 1 if has_more else None
+    next_cursor = cursor_from_row(
+        {**products[-1], "_id": ObjectId(products[-1]["_id"])}, sort_option) if has_more else None
+    return {"products": products, "nextPage": next_page, "nextCursor": next_cursor, "length": total_products}
 
 
-@router.post("/search-products-with-tags")
+@router.post("/search-products-with-tags", response_model=ProductsFromTagsResponse)
 async def fetch_products_with_tags(data: ProductsFromTagsSchema):
     # gets tags and searches products
     result = await get_products_using_tags(data)
     if result:
         return result
+
+
+@router.get("/search-index-stats")
+async def get_search_index_stats():
+    # generation and sync lag of this worker's search index
+    return {"status": "success", "stats": search_index_stats()}
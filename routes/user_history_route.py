@@ -1,7 +1,9 @@
 
-from fastapi import APIRouter
+from typing import Optional
+from fastapi import APIRouter, Query
 from schemas.product_schemas import ProductsFromTagsSchema
 from schemas.user_schemas import GetUserDataSchema
+from services.orders_service import MAX_ORDERS_PAGE
 from services.user_history_service import *
 
 router = APIRouter(prefix="/user-history")
@@ -45,7 +47,8 @@ async def order_history_tags(user_id: str):
 
 
 @router.post("/fetch-order-history")
-async def fetch_order_history(data: GetUserDataSchema):
-    result = await get_order_history(data)
+async def fetch_order_history(data: GetUserDataSchema, cursor: Optional[str] = None, limit: int = Query(20, ge=1, le=MAX_ORDERS_PAGE)):
+    # paginated, send back nextCursor for the next page
+    result = await get_order_history(data, cursor, limit)
     if result:
         return result
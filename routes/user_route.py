@@ -2,6 +2,7 @@ import json
 from fastapi import APIRouter, Response, Request
 from schemas.user_schemas import EditDetailsSchema, SignInSchema, UserSchema
 from services.users_service import signup_user, signin_user, signout_user, get_user, edit_user
+from microservices.users_microservice import profile_cache
 
 router = APIRouter(prefix="/user")
 
@@ -46,3 +47,9 @@ async def editDetails(editRequest: EditDetailsSchema):
     if (result):
         return {'status': 'success'}
     return {'status': 'failure'}
+
+
+@router.get("/profile-cache-stats")
+async def get_profile_cache_stats():
+    # hit rate of this worker's user profile cache
+    return {"status": "success", "stats": profile_cache.stats()}
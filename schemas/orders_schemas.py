@@ -1,4 +1,6 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing import List
+from schemas.cart_schemas import CartItem
 
 
 class OrderSchema(BaseModel):
@@ -8,6 +10,12 @@ class OrderSchema(BaseModel):
     quantity: int
 
 
+class CheckoutSchema(BaseModel):
+    user_id: str
+    address: str
+    items: List[CartItem] = Field(..., min_length=1, max_length=50)
+
+
 class DeleteOrderSchema(BaseModel):
     user_id: str
     order_id: str
@@ -16,4 +24,4 @@ class DeleteOrderSchema(BaseModel):
     order_date: str
 
 
-__all__ = ["OrderSchema", "DeleteOrderSchema"]
+__all__ = ["OrderSchema", "CheckoutSchema", "DeleteOrderSchema"]
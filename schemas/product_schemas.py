@@ -1,18 +1,22 @@
 import os
 import boto3
 from fastapi import File, UploadFile
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
 
-# AWS S3
+# AWS S3, AWS_S3_ENDPOINT_URL points it at a local stand-in such as moto server
 s3 = boto3.client(
     "s3",
     aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
     aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
     region_name=os.getenv("AWS_REGION"),
+    endpoint_url=os.getenv("AWS_S3_ENDPOINT_URL"),
 )
 
 BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME")
+# where uploaded objects are served from
+BUCKET_URL = os.getenv("AWS_S3_PUBLIC_URL",
+                       f"https://{BUCKET_NAME}.s3.amazonaws.com")
 
 
 class ProductSchema(BaseModel):
@@ -24,10 +28,54 @@ class ProductSchema(BaseModel):
     details: str
     price: float
     ratings: Optional[List[int]] = []
+    # urls of every uploaded image by version: original, card and detail
+    image_variants: Optional[List[Dict[str, str]]] = []
+
+
+class ImageUploadUrlsSchema(BaseModel):
+    seller: str
+    # one presigned upload is created per content type, in the same order
+    content_types: List[str] = Field(..., min_length=1, max_length=10)
+
+
+class FetchProductsSchema(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=50)
+    # only these fields of each product, all of them if not given
+    fields: Optional[List[str]] = None
 
 
 class ProductsFromTagsSchema(BaseModel):
     tags: List[str]
 
 
-__all__ = ["ProductSchema", "ProductsFromTagsSchema"]
+class ProductCardSchema(BaseModel):
+    # a product as listed in carousels and search results
+    id: str = Field(alias="_id")
+    name: str
+    price: float
+    images: List[str] = []
+    average_rating: Optional[float] = None
+    rating_count: int = 0
+
+
+class CategoryProductsResponse(BaseModel):
+    status: str
+    result: List[ProductCardSchema]
+
+
+class ProductListingResponse(BaseModel):
+    products: List[ProductCardSchema]
+    nextPage: Optional[int] = None
+    nextCursor: Optional[str] = None
+    length: int
+    searchToken: Optional[str] = None
+
+
+class ProductsFromTagsResponse(BaseModel):
+    status: str
+    products: List[ProductCardSchema]
+    details: Optional[str] = None
+
+
+__all__ = ["ProductSchema", "ProductsFromTagsSchema", "ProductCardSchema", "CategoryProductsResponse",
+           "ProductListingResponse", "ProductsFromTagsResponse"]
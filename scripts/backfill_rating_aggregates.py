@@ -0,0 +1,18 @@
+# stores rating_sum, rating_count and average_rating on products created before
+# they were kept up to date by review writes.
+# run from the repo root: python -m scripts.backfill_rating_aggregates
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+# imported after load_dotenv, mongomanager reads MONGO_DB_URL on import
+from services.review_service import backfill_rating_aggregates
+
+
+async def main():
+    updated = await backfill_rating_aggregates()
+    print(f"Backfilled rating aggregates on {updated} products")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,21 @@
+# converts Orders and User_Order_History from one document per user holding an "orders"
+# array to one document per order line, a batch of users at a time. safe to rerun.
+# run from the repo root: python -m scripts.migrate_orders_to_lines
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+# imported after load_dotenv, mongomanager reads MONGO_DB_URL on import
+from mongomanager import order_history_collection, orders_collection
+from services.orders_service import ensure_order_indexes, migrate_order_arrays
+
+
+async def main():
+    await ensure_order_indexes()
+    for name, collection in (("Orders", orders_collection), ("User_Order_History", order_history_collection)):
+        migrated = await migrate_order_arrays(collection)
+        print(f"Migrated {migrated} order lines in {name}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,6 +4,11 @@ from fastapi import FastAPI
 from fastapi_mail import ConnectionConfig
 from fastapi.middleware.cors import CORSMiddleware
 import motor.motor_asyncio
+from microservices.cart_store_microservice import cart_store
+from microservices.image_microservice import shutdown_image_pool
+from microservices.mail_microservice import mailer
+from microservices.search_microservice import build_search_index
+from microservices.search_sync_microservice import start_search_index_sync, stop_search_index_sync
 from routes.auth_route import router as auth_router
 from routes.cart_route import router as cart_router
 from routes.orders_route import router as orders_router
@@ -11,6 +16,8 @@ from routes.products_route import router as products_router
 from routes.user_route import router as user_router
 from routes.user_history_route import router as user_history_router
 from routes.review_route import router as review_router
+from services.orders_service import ensure_order_indexes
+from services.products_service import ensure_product_indexes
 
 
 load_dotenv()
@@ -38,6 +45,38 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    try:
+        await ensure_product_indexes()
+    except Exception as e:
+        print(str(e), "failed to create product indexes")
+    try:
+        await ensure_order_indexes()
+    except Exception as e:
+        print(str(e), "failed to create order indexes")
+    # build the in-memory search index before serving searches
+    try:
+        await build_search_index()
+    except Exception as e:
+        print(str(e), "failed to build search index, it will be built on first search")
+    # keep the index current with product writes from every worker
+    start_search_index_sync()
+    mailer.start()
+    # writes carts changed in the cart store back to the user documents
+    if cart_store:
+        cart_store.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await stop_search_index_sync()
+    shutdown_image_pool()
+    await mailer.stop()
+    if cart_store:
+        await cart_store.stop()
+
+
 @app.get("/")
 def connection():
     return {"message": "Connected Successfully"}
@@ -1,26 +1,27 @@
 from datetime import datetime, timedelta, timezone
-import os
+import time
 from fastapi import HTTPException
-from fastapi_mail import FastMail, MessageSchema
 import jwt
 from microservices.auth_microservice import generate_access_token, generate_verification_code
+from microservices.mail_microservice import mailer
+from microservices.users_microservice import invalidate_user_profile
+from microservices.token_microservice import decode_access_token, decode_refresh_token, issued_access_tokens
 from mongomanager import validation_token_collection, users_collection
-from schemas.auth_schemas import conf
 
 
 def validate_refresh_token(request):
     refresh_token = request.cookies.get("refresh_token")
     try:
-        if (jwt.decode(refresh_token, os.getenv("JWT_SECRET_REFRESH"), algorithms="HS256")):
+        if (decode_refresh_token(refresh_token)):
             return True
         return False
-    except:
-        return True
+    except jwt.InvalidTokenError:
+        return False
 
 
 def validate_access_token(token):
     try:
-        if (jwt.decode(token, os.getenv("JWT_SECRET_ACCESS"), algorithms="HS256", options={"verify_exp": True})):
+        if (decode_access_token(token)):
             return 200
         return 401
     except:
@@ -33,18 +34,24 @@ def create_access_token(request):
         if not refresh_token:
             print("No refresh token found.")
             return None
-        refresh_payload = jwt.decode(refresh_token.encode(), os.getenv(
-            "JWT_SECRET_REFRESH"), algorithms="HS256")
+        # concurrent refreshes of one session get the same access token instead of one each
+        new_token = issued_access_tokens.get(refresh_token)
+        if new_token:
+            return new_token
+        refresh_payload = decode_refresh_token(refresh_token)
         email = refresh_payload["sub"]
         verified = refresh_payload["verified"]
         new_token = generate_access_token(email, verified)
+        # never handed out again once the refresh token itself expired
+        issued_access_tokens.set(refresh_token, new_token, ttl=min(
+            issued_access_tokens.ttl, refresh_payload["exp"] - time.time()))
         return new_token
     except Exception as e:
         print(f"Error generating access token: ${e}")
         return None
 
 
-async def get_verification_code(bg_task, email):
+async def get_verification_code(email):
     try:
         code = generate_verification_code()
         expires_at = datetime.now(timezone.utc) + timedelta(seconds=300)
@@ -61,17 +68,15 @@ async def get_verification_code(bg_task, email):
             },
             upsert=True  # create new doc if not exists
         )
-        message = MessageSchema(
-            subject="Your Verification Code",
-            recipients=[email],  # List of recipient emails
-            body=f"Your verification code is: {code}",
-            subtype="plain"
-        )
-        # for email sending
-
-        fm = FastMail(conf)
-        bg_task.add_task(fm.send_message, message)
+        message = mailer.build_message(
+            email, "Your Verification Code", f"Your verification code is: {code}")
+        # sent by the mailer's workers over their open smtp connections
+        if not mailer.enqueue(message):
+            raise HTTPException(
+                status_code=503, detail="Too many emails queued, try again shortly")
         return True
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=403, detail=f"Error sending code: ${e}")
@@ -86,6 +91,7 @@ async def verify_verification_code(data):
     if code_data["code"] == data.code:
         await validation_token_collection.delete_one({"email": data.email})
         result = await users_collection.update_one({"email": data.email}, {"$set": {"verified": True}})
+        invalidate_user_profile(data.email)
         if result.modified_count:
             return {"status": "success", "message": "Code validated successfuly."}
         else:
@@ -1,54 +1,117 @@
 from bson import ObjectId
 from fastapi import HTTPException
-from microservices.users_microservice import find_user_by_email
-from mongomanager import users_collection
+from microservices.cache_microservice import TTLCache
+from microservices.cart_store_microservice import cart_store
+from microservices.product_microservice import PRODUCT_CARD_PROJECTION
+from mongomanager import product_collection, users_collection
+
+# user id -> email, carts in the cart store are kept by email
+user_emails = TTLCache(maxsize=10000, ttl=60 * 60)
+
+
+def cart_quantities(items):
+    quantities = {}
+    for item in items:
+        quantities[item.product_id] = quantities.get(
+            item.product_id, 0) + item.quantity
+    return quantities
+
+
+async def email_of_user(user_id: str):
+    email = user_emails.get(user_id)
+    if email is None:
+        user = await users_collection.find_one({"_id": ObjectId(user_id)}, {"email": 1})
+        if user is None:
+            return None
+        email = user["email"]
+        user_emails.set(user_id, email)
+    return email
+
+
+def merge_cart_pipeline(items):
+    # update pipeline adding the quantities of items to the cart in one atomic write:
+    # products already in the cart get their quantity increased, the rest are appended.
+    # the items go in as a $literal so their values are never read as expressions
+    quantities = cart_quantities(items)
+    incoming = [{"product_id": id, "quantity": quantity}
+                for id, quantity in quantities.items()]
+    return [{"$set": {"cart": {"$let": {
+        "vars": {"cart": {"$ifNull": ["$cart", []]}, "incoming": {"$literal": incoming}},
+        "in": {"$concatArrays": [
+            {"$map": {"input": "$$cart", "as": "item", "in": {"$mergeObjects": ["$$item", {"quantity": {"$add": [
+                "$$item.quantity",
+                {"$sum": {"$map": {
+                    "input": {"$filter": {"input": "$$incoming", "as": "new",
+                                          "cond": {"$eq": ["$$new.product_id", "$$item.product_id"]}}},
+                    "as": "new", "in": "$$new.quantity"}}},
+            ]}}]}}},
+            {"$filter": {"input": "$$incoming", "as": "new",
+                         "cond": {"$not": [{"$in": ["$$new.product_id", "$$cart.product_id"]}]}}},
+        ]},
+    }}}}]
 
 
 async def update_cart_from_local(request):
-    # updates the user cart in the db from local cart when he logs in
-    user = await find_user_by_email(request.email)
-    if not user:
+    # merges the local cart into the user cart in the db when he logs in, True if anything was added
+    if cart_store:
+        if not await cart_store.add_items(request.email, cart_quantities(request.local_cart)):
+            raise HTTPException(status_code=404, detail="User not found")
+        return bool(request.local_cart)
+    result = await users_collection.update_one({"email": request.email}, merge_cart_pipeline(request.local_cart))
+    if not result.matched_count:
         raise HTTPException(status_code=404, detail="User not found")
-    # fetch the cart from the user if exists or if not get an empty list
-    current_cart = user.get("cart", [])
-    # create a dict from the user.cart
-    cart = {str(item["product_id"]): item["quantity"] for item in current_cart}
-    for item in request.local_cart:
-        if item.product_id in cart:
-            cart[item.product_id] += item.quantity
-        else:
-            cart[item.product_id] = item.quantity
-    # returns to list
-    updated_cart = [{"product_id": id, "quantity": quantity}
-                    for id, quantity in cart.items()]
-    result = await users_collection.update_one({"email": request.email}, {"$set": {"cart": updated_cart}})
-    return result
+    return bool(result.modified_count)
 
 
 async def get_user_cart(user_data):
-    user = await users_collection.find_one({"_id": ObjectId(user_data.id)})
+    if cart_store:
+        email = await email_of_user(user_data.id)
+        cart = await cart_store.get_cart(email) if email else None
+        if cart is not None:
+            return cart
+        raise HTTPException(status_code=404, detail="User not found")
+    user = await users_collection.find_one({"_id": ObjectId(user_data.id)}, {"cart": 1})
     if user:
         return user.get("cart", [])
     raise HTTPException(status_code=404, detail="User not found")
 
 
+async def hydrate_cart(cart):
+    # joins the product cards of every cart line in one query. products that no longer
+    # exist are left out of the lines and listed in missing
+    ids = [ObjectId(item["product_id"])
+           for item in cart if ObjectId.is_valid(item["product_id"])]
+    products = await product_collection.aggregate([
+        {"$match": {"_id": {"$in": ids}}},
+        {"$project": PRODUCT_CARD_PROJECTION},
+    ]).to_list(None)
+    cards = {}
+    for product in products:
+        product["_id"] = str(product["_id"])
+        cards[product["_id"]] = product
+    lines = []
+    missing = []
+    for item in cart:
+        product = cards.get(item["product_id"])
+        if product is None:
+            missing.append(item["product_id"])
+            continue
+        lines.append({**item, "product": product,
+                      "line_total": round(product["price"] * item["quantity"], 2)})
+    return {"cart": lines, "missing": missing,
+            "total": round(sum(line["line_total"] for line in lines), 2)}
+
+
 async def add_to_cart(req):
     # adds a new item to cart or increment an existing item
     try:
-        user = await users_collection.find_one({"email": req.email})
-        if not user:
+        if cart_store:
+            if not await cart_store.add_items(req.email, cart_quantities([req.product])):
+                raise HTTPException(status_code=404, detail="User not found")
+            return True
+        result = await users_collection.update_one({"email": req.email}, merge_cart_pipeline([req.product]))
+        if not result.matched_count:
             raise HTTPException(status_code=404, detail="User not found")
-        current_cart = user.get("cart", [])
-        cart = {str(item["product_id"]): item["quantity"]
-                for item in current_cart}
-        if req.product.product_id in cart:
-            cart[req.product.product_id] += req.product.quantity
-        else:
-            cart[req.product.product_id] = req.product.quantity
-        # returns to list
-        updated_cart = [{"product_id": id, "quantity": quantity}
-                        for id, quantity in cart.items()]
-        await users_collection.update_one({"email": req.email}, {"$set": {"cart": updated_cart}})
         return True
 
     except Exception as e:
@@ -58,15 +121,48 @@ async def add_to_cart(req):
 
 async def delete_item_in_cart(req):
     try:
-        user = await users_collection.find_one({"email": req.email})
-        if not user:
+        if cart_store:
+            if not await cart_store.remove_item(req.email, req.product.product_id):
+                raise HTTPException(status_code=404, detail="User not found")
+            return True
+        result = await users_collection.update_one(
+            {"email": req.email}, {"$pull": {"cart": {"product_id": req.product.product_id}}})
+        if not result.matched_count:
             raise HTTPException(status_code=404, detail="User not found")
-
-        current_cart = user.get("cart", [])
-        updated_cart = [
-            item for item in current_cart if item["product_id"] != req.product.product_id]
-        await users_collection.update_one({"email": req.email}, {"$set": {"cart": updated_cart}})
         return True
     except Exception as e:
         print("Error deleting cart item: ", e)
         return False
+
+
+def remove_from_cart_pipeline(quantities):
+    # update pipeline taking the ordered quantities out of the cart in one write,
+    # items none is left of are dropped
+    ordered = [{"product_id": id, "quantity": quantity}
+               for id, quantity in quantities.items()]
+    return [{"$set": {"cart": {"$filter": {
+        "input": {"$map": {"input": {"$ifNull": ["$cart", []]}, "as": "item", "in": {"$mergeObjects": ["$$item", {"quantity": {"$subtract": [
+            "$$item.quantity",
+            {"$sum": {"$map": {
+                "input": {"$filter": {"input": {"$literal": ordered}, "as": "order",
+                                      "cond": {"$eq": ["$$order.product_id", "$$item.product_id"]}}},
+                "as": "order", "in": "$$order.quantity"}}},
+        ]}}]}}},
+        "as": "item",
+        "cond": {"$gt": ["$$item.quantity", 0]},
+    }}}}]
+
+
+async def remove_ordered_items(user_id: str, quantities: dict, session=None):
+    # takes ordered quantities (product_id -> quantity) out of the cart, dropping items once
+    # none is left. with a cart store the cart is written to the user document right away,
+    # otherwise the write joins the session's transaction if one is given
+    if cart_store:
+        email = await email_of_user(user_id)
+        if not email or not await cart_store.add_items(email, {id: -quantity for id, quantity in quantities.items()}):
+            return False
+        await cart_store.flush(email)
+        return True
+    result = await users_collection.update_one(
+        {"_id": ObjectId(user_id)}, remove_from_cart_pipeline(quantities), session=session)
+    return bool(result.matched_count)
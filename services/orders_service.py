@@ -3,30 +3,43 @@ import uuid
 
 from bson import ObjectId
 from fastapi import HTTPException
-from mongomanager import orders_collection, users_collection, order_history_collection
+from pymongo.errors import OperationFailure
+from microservices.cart_store_microservice import cart_store
+from microservices.pagination_microservice import find_page, seek_filter
+from services.cart_service import remove_ordered_items
+from mongomanager import client, orders_collection, order_history_collection, product_collection
+
+# set once the server turned down a transaction, a standalone mongod has none
+_transactions_supported = True
+# orders and order history hold one document per order line, newest first
+ORDERS_SORT = {"order_date": -1, "_id": -1}
+ORDER_HISTORY_SORT = {"ordered_at": -1, "_id": -1}
+MAX_ORDERS_PAGE = 100
+
+
+async def ensure_order_indexes():
+    await orders_collection.create_index([("user_id", 1), ("order_date", -1), ("_id", -1)])
+    await order_history_collection.create_index([("user_id", 1), ("ordered_at", -1), ("_id", -1)])
+
+
+def new_order_line(user_id: str, product_id: str, quantity: int, address: str):
+    return {
+        "user_id": user_id,
+        "order_id": str(uuid.uuid4()),
+        "product_id": product_id,
+        "quantity": quantity,
+        "address": address,
+        # take only the dat e of the time
+        "order_date": datetime.now(timezone.utc).date().strftime('%Y-%m-%d'),
+        "order_status": "Getting ready for shippping"
+    }
 
 
 async def upload_orders(order):
     try:
         order_dict = order.dict()
-        # take only the dat e of the time
-        order_dict["order_date"] = datetime.now(
-            timezone.utc).date().strftime('%Y-%m-%d')
-        order_id = str(uuid.uuid4())
-        await orders_collection.update_one(
-            {"user_id": order_dict["user_id"]},
-            {"$push": {
-                "orders": {
-                    "order_id": order_id,
-                    "product_id": order_dict["product_id"],
-                    "quantity": order_dict["quantity"],
-                    "address": order_dict["address"],
-                    "order_date": order_dict["order_date"],
-                    "order_status": "Getting ready for shippping"
-                }
-            }},
-            upsert=True
-        )
+        await orders_collection.insert_one(new_order_line(
+            order_dict["user_id"], order_dict["product_id"], order_dict["quantity"], order_dict["address"]))
         return True
     except Exception as e:
         print(f"Error uploading order: ${e}")
@@ -37,51 +50,136 @@ async def update_cart(order):
     try:
         # find user and update item in cart
         order_dict = order.dict()
-        await users_collection.update_one(
-            {"_id": ObjectId(order_dict["user_id"]),
-                "cart.product_id": order_dict["product_id"]},
-            # decrease item quantity
-            {"$inc": {"cart.$.quantity": -order_dict["quantity"]}})
-
-        # remove items where quantity is 0
-        await users_collection.update_one(
-            {"_id": ObjectId(order_dict["user_id"])},
-            {"$pull": {"cart": {"quantity": {"$lte": 0}}}}
-        )
-        return True
+        return await remove_ordered_items(order_dict["user_id"], {order_dict["product_id"]: order_dict["quantity"]})
     except Exception as e:
         print(f"Error Updating cart: ${e}")
         return False
 
 
-async def fetch_orders(data):
-    # get orders from user
+async def write_checkout(user_id: str, lines, quantities):
+    # all order lines go in with one insert_many and the cart is decremented with one update.
+    # both run in a transaction where the server supports them, otherwise the orders
+    # are deleted again if the cart can't be updated. a cart store is outside mongo,
+    # so with one the orders are always undone that way
+    global _transactions_supported
+
+    async def write_in_transaction(session):
+        await orders_collection.insert_many(lines, session=session)
+        if not await remove_ordered_items(user_id, quantities, session=session):
+            raise ValueError("User not found")
+    if _transactions_supported and not cart_store:
+        try:
+            async with await client.start_session() as session:
+                # runs it again on TransientTransactionError and retries the commit on
+                # UnknownTransactionCommitResult, e.g. a write conflict with another cart update
+                await session.with_transaction(write_in_transaction)
+            return
+        except OperationFailure as e:
+            # 20: IllegalOperation, transactions need a replica set or mongos
+            if e.code != 20:
+                raise
+            _transactions_supported = False
+    try:
+        # a partial insert is cleaned up too, the lines are found by their order ids
+        await orders_collection.insert_many(lines)
+        if not await remove_ordered_items(user_id, quantities):
+            raise ValueError("User not found")
+    except Exception:
+        await orders_collection.delete_many({"order_id": {"$in": [line["order_id"] for line in lines]}})
+        raise
+
+
+async def checkout(data):
+    # orders every item of the cart at once and reports how each line went
+    results = []
+    quantities = {}
+    for item in data.items:
+        quantities[item.product_id] = quantities.get(
+            item.product_id, 0) + item.quantity
+    ids = [ObjectId(id) for id in quantities if ObjectId.is_valid(id)]
+    existing = {str(product["_id"]) async for product in product_collection.find({"_id": {"$in": ids}}, {"_id": 1})}
+    lines = []
+    for id, quantity in quantities.items():
+        if quantity <= 0:
+            results.append({"product_id": id, "quantity": quantity,
+                           "status": "failure", "message": "Invalid quantity"})
+        elif id not in existing:
+            results.append({"product_id": id, "quantity": quantity,
+                           "status": "failure", "message": "Product not found"})
+        else:
+            lines.append(new_order_line(data.user_id, id, quantity, data.address))
+    if lines:
+        try:
+            await write_checkout(data.user_id, lines, {line["product_id"]: line["quantity"] for line in lines})
+            results += [{"product_id": line["product_id"], "quantity": line["quantity"],
+                         "status": "success", "order_id": line["order_id"]} for line in lines]
+        except Exception as e:
+            print(f"Error checking out: ${e}")
+            results += [{"product_id": line["product_id"], "quantity": line["quantity"],
+                         "status": "failure", "message": "Unable to complete order"} for line in lines]
+    # in the order of the cart
+    order = {id: index for index, id in enumerate(quantities)}
+    return sorted(results, key=lambda result: order[result["product_id"]])
+
+
+async def fetch_orders(data, cursor=None, limit=20):
+    # a page of the user's orders, newest first
     try:
-        orders_query = await orders_collection.find_one({"user_id": data.id})
-        if orders_query == None:
-            return {"status": "success", "orders": []}
-        orders_query["_id"] = str(orders_query["_id"])
-        return orders_query
+        # user documents that still hold an "orders" array haven't been migrated and aren't lines
+        return await find_page(orders_collection, {"user_id": data.id, "orders": {"$exists": False}}, ORDERS_SORT, cursor,
+                               min(limit, MAX_ORDERS_PAGE), {"migrated_from": 0})
+    except HTTPException:
+        raise
     except Exception as e:
         print(str(e), "failed to fetch orders")
         raise HTTPException(status_code=400, detail="Bad Request")
 
 
 async def delete_orders(data):
-    result = await orders_collection.update_one({"user_id": data.user_id}, {"$pull": {"orders": {"order_id": data.order_id}}})
-    if result.modified_count:
+    order = await orders_collection.find_one_and_delete({"user_id": data.user_id, "order_id": data.order_id})
+    if order:
         # add to order history
-        await order_history_collection.update_one(
-            {"user_id": data.user_id},
-            {
-                "$push": {
-                    "orders": {
-                        "product_id": data.product_id,
-                        "quantity": data.quantity,
-                        "ordered_at": data.order_date
-                    }
-                }
-            }, upsert=True
-        )
+        await order_history_collection.insert_one({
+            "user_id": data.user_id,
+            "product_id": order["product_id"],
+            "quantity": order["quantity"],
+            "ordered_at": order["order_date"]
+        })
         return True
     return False
+
+
+async def migrate_order_arrays(collection, batch_size=100, lines_batch_size=1000):
+    # one-off migration from one document per user with an "orders" array to one
+    # document per line. users are found in _id order, batch_size at a time, without their
+    # arrays. each array is unwound by the server and its lines inserted lines_batch_size
+    # at a time, so no whole array is held in memory. a user's lines are replaced before
+    # its old document is deleted, so the migration can be rerun
+    migrated = 0
+    last_values = None
+    while True:
+        query = {"orders": {"$exists": True}}
+        if last_values:
+            query.update(seek_filter({"_id": 1}, last_values))
+        documents = await collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not documents:
+            return migrated
+        for document in documents:
+            await collection.delete_many({"migrated_from": document["_id"]})
+            lines = []
+            async for line in collection.aggregate([
+                {"$match": {"_id": document["_id"]}},
+                {"$unwind": "$orders"},
+                {"$addFields": {"orders.user_id": "$user_id", "orders.migrated_from": "$_id"}},
+                {"$replaceRoot": {"newRoot": "$orders"}},
+            ]):
+                lines.append(line)
+                if len(lines) == lines_batch_size:
+                    await collection.insert_many(lines)
+                    migrated += len(lines)
+                    lines = []
+            if lines:
+                await collection.insert_many(lines)
+                migrated += len(lines)
+            await collection.delete_one({"_id": document["_id"]})
+        last_values = {"_id": documents[-1]["_id"]}
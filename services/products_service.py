@@ -1,62 +1,250 @@
-from io import BytesIO
+import asyncio
+from datetime import datetime, timezone
+import os
 import random
+import secrets
 from bson import ObjectId
-from rapidfuzz import process, utils
 from fastapi import HTTPException
-from microservices.product_microservice import generate_key, get_products_from_tags
-from mongomanager import product_collection
-from schemas.product_schemas import BUCKET_NAME, s3
+from pymongo import UpdateOne
+from microservices.cache_microservice import TTLCache
+from microservices.product_microservice import PRODUCT_CARD_PROJECTION, digest_from_key, generate_content_key, generate_key, get_products_from_tags, hash_file, invalidate_product, is_generated_key, product_cache
+from microservices.image_microservice import make_image_variants
+from microservices.s3_microservice import MAX_IMAGE_BYTES, PRESIGNED_URL_SECONDS, delete_keys, head_key, key_from_url, object_url, presign_upload, upload_bytes, upload_image
+from microservices.search_microservice import ensure_search_index, search_index
+from mongomanager import image_hash_collection, image_upload_collection, product_collection
+
+# totals of category listings, they only need to be roughly current for the page count
+listing_counts = TTLCache(maxsize=256, ttl=float(
+    os.getenv("PRODUCT_COUNT_CACHE_SECONDS", 60)))
+# products sampled per category for the homepage carousels, 0 samples on every request
+CATEGORY_POOL_SIZE = int(os.getenv("CATEGORY_SAMPLE_POOL_SIZE", 0))
+category_pools = TTLCache(maxsize=128, ttl=float(
+    os.getenv("CATEGORY_SAMPLE_POOL_SECONDS", 300)))
+# ranked search results kept between the pages of an infinite scroll
+search_sessions = TTLCache(maxsize=int(os.getenv("SEARCH_SESSION_CACHE_SIZE", 512)),
+                           ttl=float(os.getenv("SEARCH_SESSION_SECONDS", 300)))
+# how long a key issued for a presigned upload can be claimed by a product, well past the
+# url expiry so a slow upload can still be sent to upload-product
+IMAGE_UPLOAD_KEY_SECONDS = int(os.getenv("IMAGE_UPLOAD_KEY_SECONDS", max(PRESIGNED_URL_SECONDS * 6, 3600)))
+
+
+async def ensure_product_indexes():
+    # the search index finds changed products by updated_at when it can't use change streams
+    await product_collection.create_index("updated_at")
+    # keyset pagination seeks on the sort key followed by _id. an index is only walked in
+    # its own direction or fully reversed, so high-to-low (price -1, _id 1) needs its own
+    await product_collection.create_index([("price", 1), ("_id", 1)])
+    await product_collection.create_index([("category", 1), ("price", 1), ("_id", 1)])
+    await product_collection.create_index([("price", -1), ("_id", 1)])
+    await product_collection.create_index([("category", 1), ("price", -1), ("_id", 1)])
+    await product_collection.create_index([("average_rating", -1), ("_id", 1)])
+    await product_collection.create_index([("category", 1), ("average_rating", -1), ("_id", 1)])
+    # keys issued for presigned uploads are dropped by mongo once they can't be claimed
+    await image_upload_collection.create_index("created_at", expireAfterSeconds=IMAGE_UPLOAD_KEY_SECONDS)
 
 
 async def upload_product_db(product):
     try:
         # holds the urls to be saved in the db with the product
         product_data = product.dict()
+        # lets the search index pick up the write when it polls for changes
+        product_data["updated_at"] = datetime.now(timezone.utc)
+        # rating aggregates are kept up to date by the review writes
+        product_data.update(rating_sum=0, rating_count=0, average_rating=None)
         await product_collection.insert_one(product_data)
+        invalidate_product(product_data["_id"])
+        # update this worker's index right away, others get it from the change feed
+        search_index.upsert_product(product_data)
         return True
     except Exception as e:
         return False
 
 
 async def get_product(id: str):
+    # None for ids that aren't valid or not found
+    products, _ = await get_products_by_ids([id])
+    return products[0] if products else None
+
+
+async def get_products_by_ids(ids, fields=None):
+    # products in the order of ids from the product cache and one $in query for the rest,
+    # with only the given fields if any. returns them and the ids that weren't found
+    found = {}
+    missing_ids = []
+    for id in dict.fromkeys(ids):
+        product = product_cache.get(id) if ObjectId.is_valid(id) else None
+        if product is not None:
+            found[id] = product
+        elif ObjectId.is_valid(id):
+            missing_ids.append(ObjectId(id))
+    if missing_ids:
+        # whole documents are cached, projected ones only answer this request
+        projection = {field: 1 for field in fields} if fields else None
+        async for product in product_collection.find({"_id": {"$in": missing_ids}}, projection):
+            product["_id"] = str(product["_id"])
+            found[product["_id"]] = product
+            if not fields:
+                product_cache.set(product["_id"], product)
+    products = []
+    missing = []
+    for id in ids:
+        product = found.get(id)
+        if product is None:
+            missing.append(id)
+        elif fields:
+            products.append({key: value for key, value in product.items()
+                             if key == "_id" or key in fields})
+        else:
+            products.append(dict(product))
+    return products, missing
+
+
+async def upload_product_image(image):
+    # uploads the original and its resized WebP variants, returns the url of every version.
+    # an image that was uploaded before is not uploaded again, one that can't be decoded
+    # is kept without variants
+    digest = await asyncio.to_thread(hash_file, image.file)
+    known_image = await image_hash_collection.find_one({"_id": digest})
+    if known_image:
+        return known_image["urls"]
+    key = generate_content_key(digest)
     try:
-        product = await product_collection.find_one({"_id": ObjectId(id)})
-        if not product:
-            raise HTTPException(
-                status_code=404, detail="No product found for the given id")
-        product["_id"] = str(product["_id"])
-        return product
-    except:
-        return None
+        variants = await make_image_variants(image.file)
+    except Exception as e:
+        print(f"Could not create variants of {image.filename}: {e}")
+        variants = {}
+    # the variants are rendered first, boto3 closes the upload once the original is sent
+    keys = {"original": key, **{name: f"{key}_{name}.webp" for name in variants}}
+    results = await asyncio.gather(upload_image(image, key),
+                                   *(upload_bytes(variants[name], keys[name], "image/webp") for name in variants),
+                                   return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        # the versions that made it are content addressed and kept, see delete_uploaded_images
+        raise errors[0]
+    return {name: object_url(uploaded_key) for name, uploaded_key in keys.items()}
 
 
 async def images_to_links(images):
-    image_urls = []
+    # uploads the images concurrently, False if any of them fails
+    results = await asyncio.gather(*(upload_product_image(image) for image in images),
+                                   return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        print(f"Error uploading images: {errors[0]}")
+        return False
     for image in images:
-        key = generate_key()
-        try:
-            image_content = await image.read()
-            # Create a file-like object from the bytes
-            file_like_object = BytesIO(image_content)
-            s3.upload_fileobj(file_like_object, BUCKET_NAME, key)
-            print(f"Successfully uploaded: {image.filename}")
-            image_url = f"https://{BUCKET_NAME}.s3.amazonaws.com/{key}"
-            image_urls.append(image_url)
-        except Exception as e:
+        print(f"Successfully uploaded: {image.filename}")
+    return results
+
+
+async def create_image_upload_urls(seller, content_types):
+    # presigned urls the client uploads the images to itself, bypassing this server.
+    # the keys are recorded for the seller, upload-product only accepts keys issued to it
+    keys = [generate_key() for _ in content_types]
+    now = datetime.now(timezone.utc)
+    await image_upload_collection.insert_many([{"_id": key, "seller": seller, "claimed": False, "created_at": now}
+                                               for key in keys])
+    return [presign_upload(key, content_type) for key, content_type in zip(keys, content_types)]
+
+
+async def claim_upload_keys(keys, seller):
+    # marks keys issued to the seller as used by one product, so no other product or rollback
+    # can take them. all or nothing, False if any key wasn't issued to the seller or is taken
+    claims = await asyncio.gather(*(image_upload_collection.find_one_and_update(
+        {"_id": key, "seller": seller, "claimed": False}, {"$set": {"claimed": True}}, {"_id": 1})
+        for key in keys))
+    if all(claims):
+        return True
+    await release_upload_keys([claim["_id"] for claim in claims if claim])
+    return False
+
+
+async def release_upload_keys(keys):
+    if keys:
+        await image_upload_collection.update_many({"_id": {"$in": keys}}, {"$set": {"claimed": False}})
+
+
+async def verify_uploaded_keys(keys, seller):
+    # checks the images uploaded with presigned urls were issued to the seller and exist
+    # before a product points at them. returns their urls like images_to_links does, or False.
+    # on success the keys are claimed by this request, only its rollback may delete them
+    if not keys or not all(isinstance(key, str) and is_generated_key(key) for key in keys) or len(set(keys)) != len(keys):
+        return False
+    try:
+        if not await claim_upload_keys(keys, seller):
+            print(f"Uploaded image keys weren't issued to {seller}")
             return False
-    return image_urls
+    except Exception as e:
+        print(f"Error claiming uploaded images: {e}")
+        return False
+    try:
+        heads = await asyncio.gather(*(head_key(key) for key in keys))
+    except Exception as e:
+        print(f"Error checking uploaded images: {e}")
+        heads = None
+    valid = heads is not None
+    for key, head in zip(keys, heads or []):
+        if head is None or not head.get("ContentType", "").startswith("image/") or head["ContentLength"] > MAX_IMAGE_BYTES:
+            print(f"Uploaded image is missing or invalid: {key}")
+            valid = False
+    if not valid:
+        # the client may upload again and retry with the same keys
+        await release_upload_keys(keys)
+        return False
+    return [{"original": object_url(key)} for key in keys]
+
+
+async def remember_uploaded_images(uploaded_images):
+    # records the images of a saved product by content hash so later uploads of them are skipped
+    requests = [UpdateOne({"_id": digest_from_key(key_from_url(urls["original"]))},
+                          {"$setOnInsert": {"urls": urls, "created_at": datetime.now(timezone.utc)}}, upsert=True)
+                for urls in uploaded_images if digest_from_key(key_from_url(urls["original"]))]
+    try:
+        if requests:
+            await image_hash_collection.bulk_write(requests, ordered=False)
+    except Exception as e:
+        print(f"Error saving image hashes: {e}")
+
+
+async def delete_uploaded_images(image_urls):
+    # rollback for images of a product that won't be saved. images stored under their content
+    # hash are kept: another upload of the same image may be using them before its product is
+    # saved and its hash recorded. an unused one is at most one copy per distinct image, and
+    # uploading that image again overwrites it rather than adding another
+    try:
+        await delete_keys([key for key in map(key_from_url, image_urls) if digest_from_key(key) is None])
+    except Exception as e:
+        print(f"Error deleting uploaded images: {e}")
+
+
+async def sample_category(category, number):
+    # random products of a category picked by the db, as product cards
+    pipeline = [
+        {"$match": {"category": category}},
+        {"$sample": {"size": number}},
+        {"$project": PRODUCT_CARD_PROJECTION},
+    ]
+    products = await product_collection.aggregate(pipeline).to_list(number)
+    for product in products:
+        product["_id"] = str(product["_id"])
+    return products
 
 
 async def query_product_by_category(category, number):
     # get a specific amount of different products from based on their category
-    result = await product_collection.find({"category": category}).to_list(None)
-    if not result:
+    if CATEGORY_POOL_SIZE and number <= CATEGORY_POOL_SIZE:
+        # hot categories are served from a sampled pool that is drawn again once it expires
+        pool = category_pools.get(category)
+        if pool is None:
+            pool = await sample_category(category, CATEGORY_POOL_SIZE)
+            category_pools.set(category, pool)
+        products_to_send = random.sample(pool, min(len(pool), number))
+    else:
+        products_to_send = await sample_category(category, number)
+    if not products_to_send:
         raise HTTPException(
             status_code=404, detail="No products found for the given category")
-    sample_size = min(len(result), number)
-    products_to_send = random.sample(result, sample_size)
-    for product in products_to_send:
-        product["_id"] = str(product["_id"])
     return products_to_send
 
 
@@ -66,15 +254,12 @@ async def get_search_query(search, rnd, category):
     if category:
         query["category"] = category
     if search:
-        # filter products by the search
-        all_products = await product_collection.find(query, {"_id": 1, "name": 1, "tags": 1, "category": 1}).to_list(None)
-        matched_ids = []
-        for product in all_products:
-            product_score = process.extractOne(search,
-                                               [word for word in product["name"].split() if len(word) > 2] + [product["category"]] + [tag for tag in product["tags"] if len(tag) > 1], processor=utils.default_process)
-            if product_score[1] > 85:
-                matched_ids.append(product["_id"])
-                relevance_map[str(product["_id"])] = product_score[1]
+        # filter products by the search using the in-memory index
+        await ensure_search_index()
+        scores = search_index.search(search, category)
+        matched_ids = list(scores)
+        relevance_map = {str(product_id): score
+                         for product_id, score in scores.items()}
         if rnd:
             matched_ids = random.sample(matched_ids, 4)
         query["_id"] = {"$in": matched_ids}
@@ -84,43 +269,108 @@ async def get_search_query(search, rnd, category):
     return query, relevance_map
 
 
-async def get_relevant_products(query):
-    total_products = await product_collection.count_documents(query)
-    return total_products
+async def get_search_session(search_token, search, category, sort_option):
+    # reuses the ranked ids of an earlier page of the same search, or ranks them now
+    key = (search, category, tuple(sort_option.items()))
+    session = search_sessions.get(search_token) if search_token else None
+    if session and session["key"] == key:
+        return session
+    query, relevance_map = await get_search_query(search, False, category)
+    session = {
+        "token": secrets.token_urlsafe(16),
+        "key": key,
+        "ids": await rank_product_ids(query, relevance_map, sort_option),
+        "relevance_map": relevance_map,
+    }
+    search_sessions.set(session["token"], session)
+    return session
 
 
-async def build_product_query_pipeline(query, relevance_map, sort_option, skip_count, per_page):
+async def rank_product_ids(query, relevance_map, sort_option):
+    # every matching id in the order of the sort option
+    if "relevence_score" in sort_option:
+        return sorted(query["_id"]["$in"], key=lambda product_id: (-relevance_map[str(product_id)], product_id))
     pipeline = [
         {"$match": query},
-        {"$unwind": {
-            "path": "$ratings",
-            "preserveNullAndEmptyArrays": True}
-         },
-        {
-            "$group": {
-                "_id": "$_id",
-                "name": {"$first": "$name"},
-                "price": {"$first": "$price"},
-                "seller": {"$first": "$seller"},
-                "images": {"$first": "$images"},
-                "ratings": {"$push": "$ratings"},
-                "average_rating": {"$avg": "$ratings.rating"},
-            }
-        },
-        {
-            "$addFields": {
-                "relevence_score": {
-                    "$getField": {
-                        "field": {"$toString": "$_id"},
-                        "input": relevance_map
-                    }
+        {"$sort": sort_option},
+        {"$project": {"_id": 1}},
+    ]
+    products = await product_collection.aggregate(pipeline).to_list(None)
+    return [product["_id"] for product in products]
+
+
+async def get_search_page(session, skip_count, per_page):
+    # fetches only the products of the requested page, in their ranked order
+    page_ids = session["ids"][skip_count:skip_count + per_page]
+    relevance_map = {str(product_id): session["relevance_map"][str(product_id)]
+                     for product_id in page_ids}
+    pipeline = await build_product_query_pipeline({"_id": {"$in": page_ids}}, relevance_map, {"_id": 1}, 0, per_page)
+    products = await product_pipeline(pipeline, per_page)
+    position = {str(product_id): i for i, product_id in enumerate(page_ids)}
+    products.sort(key=lambda product: position[product["_id"]])
+    return products
+
+
+async def get_products_page(query, relevance_map, sort_option, skip_count, limit, seek=None):
+    # returns the page and the total count of query in a single round trip. listings that
+    # aren't searches reuse a recently counted total and only run the indexed page pipeline
+    count_key = None if "_id" in query else query.get("category", "")
+    total_products = listing_counts.get(count_key) if count_key is not None else None
+    if total_products is None and count_key == "":
+        # the whole catalog is only counted approximately, from collection metadata
+        total_products = await product_collection.estimated_document_count()
+        listing_counts.set(count_key, total_products)
+    if total_products is not None:
+        pipeline = await build_product_query_pipeline(query, relevance_map, sort_option, skip_count, limit, seek)
+        return await product_pipeline(pipeline, limit), total_products
+    page_pipeline = await build_product_query_pipeline({}, relevance_map, sort_option, skip_count, limit, seek)
+    if page_pipeline[0] == {"$match": {}}:
+        page_pipeline = page_pipeline[1:]
+    pipeline = [
+        {"$match": query},
+        {"$facet": {
+            "products": page_pipeline,
+            "total": [{"$count": "count"}],
+        }},
+    ]
+    result = (await product_collection.aggregate(pipeline).to_list(1))[0]
+    total_products = result["total"][0]["count"] if result["total"] else 0
+    if count_key is not None:
+        listing_counts.set(count_key, total_products)
+    # change id to str so python could handle it
+    for product in result["products"]:
+        product["_id"] = str(product["_id"])
+    return result["products"], total_products
+
+
+async def build_product_query_pipeline(query, relevance_map, sort_option, skip_count, per_page, seek=None):
+    # ratings are aggregated on the product when reviews are written, so every sort except
+    # relevance runs on a stored, indexed field. seek continues after a keyset cursor
+    relevance_stage = {
+        "$addFields": {
+            "relevence_score": {
+                "$getField": {
+                    "field": {"$toString": "$_id"},
+                    "input": relevance_map
                 }
-            },
+            }
         },
+    }
+    page_stages = [
         {"$sort": sort_option},  # Apply sorting
         {"$skip": skip_count},  # skip the sent pages
         {"$limit": per_page}
     ]
+    if "relevence_score" in sort_option:
+        # the score only exists after it is added, so it can't seek or sort any earlier
+        pipeline = [{"$match": query}, relevance_stage,
+                    *([{"$match": seek}] if seek else []), *page_stages]
+    else:
+        pipeline = [{"$match": {"$and": [query, seek]} if seek else query},
+                    *page_stages, relevance_stage]
+    # the sort fields are kept for the cursor of the next page, the response drops the extra ones
+    pipeline.append({"$project": {**PRODUCT_CARD_PROJECTION,
+                                  **{field: 1 for field in sort_option if field not in PRODUCT_CARD_PROJECTION}}})
     return pipeline
 
 
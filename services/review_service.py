@@ -1,33 +1,87 @@
 from bson import ObjectId
+from microservices.product_microservice import invalidate_product
 from mongomanager import product_collection
 
+# recomputes average_rating from the stored sum and count
+AVERAGE_RATING_STAGE = {"$set": {"average_rating": {"$cond": [
+    {"$gt": ["$rating_count", 0]},
+    {"$divide": ["$rating_sum", "$rating_count"]},
+    None
+]}}}
+# products written before the aggregates existed fall back to their ratings array
+RATING_SUM = {"$ifNull": ["$rating_sum", {"$sum": "$ratings.rating"}]}
+RATING_COUNT = {"$ifNull": [
+    "$rating_count", {"$size": {"$ifNull": ["$ratings", []]}}]}
+
 
 async def update_review(review):
+    # replaces the first review of the user and moves the rating sum by the difference,
+    # all in one update pipeline so concurrent reviews can't leave the aggregates off
     update_result = await product_collection.update_one(
         {"_id": ObjectId(review.product_id),
          "ratings.user_id": review.user_id},
-        {
-            "$set": {
-                "ratings.$.details": review.review_text,
-                "ratings.$.rating": review.rating,
-            }
-        },
+        [
+            {"$set": {"_review_index": {"$indexOfArray": [
+                "$ratings.user_id", {"$literal": review.user_id}]}}},
+            {"$set": {
+                "rating_sum": {"$subtract": [
+                    {"$add": [RATING_SUM, review.rating]},
+                    {"$arrayElemAt": ["$ratings.rating", "$_review_index"]}
+                ]},
+                "rating_count": RATING_COUNT,
+                "ratings": {"$map": {
+                    "input": {"$range": [0, {"$size": "$ratings"}]},
+                    "as": "index",
+                    "in": {"$cond": [
+                        {"$eq": ["$$index", "$_review_index"]},
+                        {"$mergeObjects": [
+                            {"$arrayElemAt": ["$ratings", "$$index"]},
+                            {"$literal": {"details": review.review_text,
+                                          "rating": review.rating}}
+                        ]},
+                        {"$arrayElemAt": ["$ratings", "$$index"]}
+                    ]}
+                }},
+            }},
+            {"$unset": "_review_index"},
+            AVERAGE_RATING_STAGE,
+        ]
     )
+    invalidate_product(review.product_id)
     return update_result
 
 
 async def add_review(review):
     insert_result = await product_collection.update_one(
         {"_id": ObjectId(review.product_id)},
-        {
-            "$push": {
-                "ratings": {
-                    "username": review.username,
-                    "user_id": review.user_id,
-                    "details": review.review_text,
-                    "rating": review.rating,
-                }
-            }
-        }
+        [
+            {"$set": {
+                "ratings": {"$concatArrays": [
+                    {"$ifNull": ["$ratings", []]},
+                    [{"$literal": {
+                        "username": review.username,
+                        "user_id": review.user_id,
+                        "details": review.review_text,
+                        "rating": review.rating,
+                    }}]
+                ]},
+                "rating_sum": {"$add": [RATING_SUM, review.rating]},
+                "rating_count": {"$add": [RATING_COUNT, 1]},
+            }},
+            AVERAGE_RATING_STAGE,
+        ]
     )
+    invalidate_product(review.product_id)
     return insert_result
+
+
+async def backfill_rating_aggregates():
+    # one-off migration for products stored before the aggregates were kept on review writes
+    result = await product_collection.update_many(
+        {"rating_count": {"$exists": False}},
+        [
+            {"$set": {"rating_sum": RATING_SUM, "rating_count": RATING_COUNT}},
+            AVERAGE_RATING_STAGE,
+        ]
+    )
+    return result.modified_count
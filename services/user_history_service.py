@@ -1,7 +1,9 @@
 from fastapi import HTTPException
-from microservices.product_microservice import get_products_from_tags
+from microservices.pagination_microservice import find_page
+from microservices.product_microservice import get_products_from_tags, match_products_from_tags
 from mongomanager import user_search_history_collection, user_visited_collection, order_history_collection
 from microservices.user_history_micoservice import *
+from services.orders_service import MAX_ORDERS_PAGE, ORDER_HISTORY_SORT
 
 
 async def save_user_search_history(user_id, search_query):
@@ -79,16 +81,15 @@ async def fetch_user_search_history(user_id):
 
 async def get_order_tags(user_id):
     try:
-        result = await order_history_collection.find_one({"user_id": user_id})
-        if result:
-            order_ids = [order["product_id"] for order in result["orders"]]
-            if len(order_ids) > 0:
-                tag_list = await fetch_product_tags(order_ids)
-                test = await get_products_from_tags(tag_list)
-                if len(test) >= 4:
-                    return {"status": "success", "tags": tag_list}
-                return {"status": "failure", "tags": [], "details": "No sufficient products"}
-            return {"status": "failure", "tags": [], "details": "No History Found"}
+        order_ids = await order_history_collection.distinct("product_id", {"user_id": user_id})
+        if len(order_ids) > 0:
+            tag_list = await fetch_product_tags(order_ids)
+            # only check that enough products fit, they are fetched by the client later
+            matching_ids = await match_products_from_tags(tag_list)
+            if len(matching_ids) >= 4:
+                return {"status": "success", "tags": tag_list}
+            return {"status": "failure", "tags": [], "details": "No sufficient products"}
+        return {"status": "failure", "tags": [], "details": "No History Found"}
     except Exception as e:
         print(str(e), "failed to fetch history tags")
         raise HTTPException(
@@ -109,9 +110,12 @@ async def get_products_using_tags(data):
             status_code=400, detail="Could Not Fetch Products")
 
 
-async def get_order_history(data):
+async def get_order_history(data, cursor=None, limit=20):
+    # a page of the user's past orders, newest first
     user_id = data.id
-    result = await order_history_collection.find_one({"user_id": user_id})
-    if result:
-        return {"status": "success", "orders": result["orders"]}
-    return {"status": "failure", "details": "No order history found", "orders": []}
+    # user documents that still hold an "orders" array haven't been migrated and aren't lines
+    orders, next_cursor = await find_page(order_history_collection, {"user_id": user_id, "orders": {"$exists": False}}, ORDER_HISTORY_SORT,
+                                          cursor, min(limit, MAX_ORDERS_PAGE), {"migrated_from": 0})
+    if orders:
+        return {"status": "success", "orders": orders, "nextCursor": next_cursor}
+    return {"status": "failure", "details": "No order history found", "orders": [], "nextCursor": None}
@@ -1,21 +1,24 @@
-import os
 from fastapi import HTTPException
 from fastapi_mail import ConnectionConfig, FastMail, MessageSchema
-import jwt
 from mongomanager import users_collection
-from microservices.auth_microservice import generate_access_token, generate_refresh_token, validate_user_details
-from microservices.users_microservice import compare_passwords, find_user_by_email, hash_password, save_user, createCookie
+from microservices.token_microservice import decode_access_token
+from microservices.auth_microservice import generate_access_token, generate_refresh_token, is_domain_deliverable, validate_user_details
+from microservices.users_microservice import compare_passwords, find_user_by_email, get_user_profile, hash_password, invalidate_user_profile, needs_rehash, rehash_password, save_user, createCookie
 
 
 async def signup_user(user):
     user_data = user.dict()
-    user_data["password"] = hash_password(user_data["password"])
+    # cheapest checks first, requests that fail them never reach dns or a bcrypt worker
     if not validate_user_details(user):
         raise HTTPException(status_code=400, detail="Invalid Details")
     existing_user = await find_user_by_email(user_data["email"])
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    await save_user()
+    if not await is_domain_deliverable(user_data["email"]):
+        raise HTTPException(status_code=400, detail="Invalid Details")
+    user_data["password"] = await hash_password(user_data["password"])
+    await save_user(user_data)
+    invalidate_user_profile(user_data["email"])
 
 
 async def signin_user(user, response):
@@ -23,7 +26,9 @@ async def signin_user(user, response):
     found_user = await find_user_by_email(user.email)
     if found_user == None:
         raise HTTPException(status_code=404, detail="User Not Found")
-    compare_passwords(user.password, found_user["password"])
+    await compare_passwords(user.password, found_user["password"])
+    if needs_rehash(found_user["password"]):
+        await rehash_password(found_user["_id"], user.password, found_user["password"])
     refresh_token = generate_refresh_token(
         found_user["email"], found_user["verified"], user.remember)
     createCookie(user.remember, response, refresh_token)
@@ -47,17 +52,8 @@ async def signout_user(request, response):
 
 async def get_user(token):
     try:
-        payload = jwt.decode(token, os.getenv(
-            "JWT_SECRET_ACCESS"), algorithms="HS256")
-        result = await users_collection.find_one({"email": payload["sub"]})
-        user = {
-            "_id": str(result["_id"]),
-            "email": result["email"],
-            "verified": result["verified"],
-            "name": result["name"],
-            "address": result["address"]
-        }
-        return user
+        payload = decode_access_token(token)
+        return await get_user_profile(payload["sub"])
     except:
         return None
 
@@ -68,6 +64,7 @@ async def edit_user(new_data):
         update_operation = {
             '$set': {'name': new_data.name, 'address': new_data.address}}
         await users_collection.update_one(query_filter, update_operation)
+        invalidate_user_profile(new_data.userValidationEmail)
         return True
     except:
         return False
@@ -0,0 +1,24 @@
+import os
+import sys
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+# settings the app reads on import, tests never reach the real services
+os.environ.setdefault("EMAIL_USERNAME", "test")
+os.environ.setdefault("EMAIL_PASSWORD", "test")
+os.environ.setdefault("AWS_REGION", "us-east-1")
+os.environ.setdefault("AWS_S3_BUCKET_NAME", "test-bucket")
+os.environ.setdefault("JWT_SECRET_ACCESS", "test-access")
+os.environ.setdefault("JWT_SECRET_REFRESH", "test-refresh")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def client_for():
+    # a test client for an app serving only the given router
+    def make(router):
+        app = FastAPI()
+        app.include_router(router)
+        return TestClient(app)
+    return make
@@ -0,0 +1,55 @@
+import asyncio
+import os
+import secrets
+import motor.motor_asyncio
+import pytest
+from pymongo.errors import PyMongoError
+from schemas.cart_schemas import CartItem, MutateCartSchema, SaveLocalCart
+import services.cart_service as cart_service
+
+MONGO_DB_URL = os.getenv("MONGO_DB_URL", "mongodb://localhost:27017")
+REQUESTS = 200
+PRODUCTS = ["p1", "p2", "p3", "p4"]
+MERGES = 10
+
+
+async def concurrent_adds(monkeypatch):
+    # the update pipelines need a real server, mongomock can't run them
+    client = motor.motor_asyncio.AsyncIOMotorClient(MONGO_DB_URL, serverSelectionTimeoutMS=1000)
+    try:
+        await client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        return None
+    users = client.get_database("BuyIt_test").get_collection("Users")
+    monkeypatch.setattr(cart_service, "users_collection", users)
+    email = f"cart-test-{secrets.token_hex(6)}@example.com"
+    await users.insert_one({"email": email, "cart": []})
+    try:
+        adds = [cart_service.add_to_cart(MutateCartSchema(
+            email=email, product=CartItem(product_id=PRODUCTS[i % len(PRODUCTS)], quantity=1)))
+            for i in range(REQUESTS)]
+        local_cart = SaveLocalCart(email=email, local_cart=[CartItem(product_id=id, quantity=1) for id in PRODUCTS])
+        merges = [cart_service.update_cart_from_local(local_cart) for _ in range(MERGES)]
+        results = await asyncio.gather(*adds, *merges)
+        assert all(results[:REQUESTS])
+        # a removal racing with more adds
+        results = await asyncio.gather(
+            cart_service.delete_item_in_cart(MutateCartSchema(email=email, product=CartItem(product_id="p1", quantity=0))),
+            *(cart_service.add_to_cart(MutateCartSchema(email=email, product=CartItem(product_id="p2", quantity=1)))
+              for _ in range(20)))
+        assert all(results)
+        user = await users.find_one({"email": email})
+        return {item["product_id"]: item["quantity"] for item in user["cart"]}
+    finally:
+        await users.delete_one({"email": email})
+        client.close()
+
+
+def test_concurrent_cart_updates_keep_every_quantity(monkeypatch):
+    monkeypatch.setattr(cart_service, "cart_store", None)
+    cart = asyncio.run(concurrent_adds(monkeypatch))
+    if cart is None:
+        pytest.skip(f"no MongoDB at {MONGO_DB_URL}")
+    expected = REQUESTS // len(PRODUCTS) + MERGES
+    assert cart == {"p2": expected + 20, "p3": expected, "p4": expected}
@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+import microservices.cart_store_microservice as cart_store_microservice
+from microservices.cart_store_microservice import MemoryCartStore, RedisCartStore
+
+
+class FakeUsers:
+    # the user document reads and version guarded writes of load_cart and save_cart
+    def __init__(self, users):
+        self.users = users
+
+    async def find_one(self, query, projection=None):
+        user = self.users.get(query["email"])
+        return None if user is None else dict(user)
+
+    async def update_one(self, query, update):
+        user = self.users.get(query["email"])
+        version = update["$set"]["cart_version"]
+        if user is not None and user.get("cart_version", -1) < version:
+            user.update(update["$set"])
+
+
+def redis_store():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return RedisCartStore(fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+@pytest.fixture(params=["memory", "redis"])
+def make_store(request, monkeypatch):
+    def make(users):
+        monkeypatch.setattr(cart_store_microservice, "users_collection", FakeUsers(users))
+        return MemoryCartStore() if request.param == "memory" else redis_store()
+    return make
+
+
+def cart_of(users, email):
+    return {item["product_id"]: item["quantity"] for item in users[email]["cart"]}
+
+
+def test_add_update_and_remove(make_store):
+    users = {"a@example.com": {"email": "a@example.com", "cart": [{"product_id": "p1", "quantity": 2}]}}
+    store = make_store(users)
+
+    async def run():
+        assert await store.add_items("a@example.com", {"p1": 1, "p2": 3})
+        assert await store.add_items("a@example.com", {"p2": -1})
+        # a negative quantity taking an item to 0 removes it
+        assert await store.add_items("a@example.com", {"p1": -3})
+        assert await store.add_items("a@example.com", {"p3": 1})
+        assert await store.remove_item("a@example.com", "p3")
+        assert not await store.add_items("missing@example.com", {"p1": 1})
+        assert await store.get_cart("missing@example.com") is None
+        return await store.get_cart("a@example.com")
+    assert asyncio.run(run()) == [{"product_id": "p2", "quantity": 2}]
+
+
+def test_concurrent_adds_keep_every_quantity(make_store):
+    users = {"a@example.com": {"email": "a@example.com", "cart": []}}
+    store = make_store(users)
+
+    async def run():
+        results = await asyncio.gather(*(store.add_items("a@example.com", {f"p{i % 4}": 1}) for i in range(200)))
+        assert all(results)
+        return {item["product_id"]: item["quantity"] for item in await store.get_cart("a@example.com")}
+    assert asyncio.run(run()) == {f"p{i}": 50 for i in range(4)}
+
+
+def test_flush_writes_dirty_carts_with_their_version(make_store):
+    users = {email: {"email": email, "cart": []} for email in ("a@example.com", "b@example.com")}
+    store = make_store(users)
+
+    async def run():
+        await store.add_items("a@example.com", {"p1": 2})
+        await store.add_items("b@example.com", {"p2": 1})
+        await store.flush("a@example.com")
+        assert cart_of(users, "a@example.com") == {"p1": 2}
+        assert users["b@example.com"]["cart"] == []
+        await store.add_items("a@example.com", {"p1": 1})
+        await store.flush()
+        assert cart_of(users, "a@example.com") == {"p1": 3}
+        assert cart_of(users, "b@example.com") == {"p2": 1}
+        # nothing is dirty any more, a stale write can't go back past the stored version
+        version = users["a@example.com"]["cart_version"]
+        await cart_store_microservice.save_cart("a@example.com", {"p1": 1}, version - 1)
+        assert cart_of(users, "a@example.com") == {"p1": 3}
+    asyncio.run(run())
+
+
+def test_redis_scripts_on_carts_that_arent_loaded(monkeypatch):
+    monkeypatch.setattr(cart_store_microservice, "users_collection", FakeUsers({}))
+    store = redis_store()
+
+    async def run():
+        # incr and remove leave a missing cart alone, set_if_missing never overwrites
+        assert not await store._incr("a@example.com", {"p1": 1})
+        assert not await store._remove("a@example.com", "p1")
+        assert await store.client.exists(store._key("a@example.com")) == 0
+        await store._set_if_missing("a@example.com", {"p1": 2}, 7)
+        await store._set_if_missing("a@example.com", {"p9": 9}, 1)
+        assert await store._get("a@example.com") == ({"p1": 2}, 7)
+        assert await store._incr("a@example.com", {"p1": -2, "p2": 1})
+        assert await store._get("a@example.com") == ({"p2": 1}, 8)
+        # an emptied cart keeps its version, so it isn't loaded again over newer changes
+        assert await store._remove("a@example.com", "p2")
+        assert await store._get("a@example.com") == ({}, 9)
+        assert await store.client.ttl(store._key("a@example.com")) > 0
+    asyncio.run(run())
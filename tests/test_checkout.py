@@ -0,0 +1,29 @@
+import asyncio
+import pytest
+from pymongo.errors import AutoReconnect
+import services.orders_service as orders_service
+
+
+class FakeOrders:
+    # writes the first line of an insert_many, then fails like a dropped connection
+    def __init__(self):
+        self.lines = []
+
+    async def insert_many(self, lines):
+        self.lines.append(lines[0])
+        raise AutoReconnect("connection closed")
+
+    async def delete_many(self, query):
+        order_ids = set(query["order_id"]["$in"])
+        self.lines = [line for line in self.lines if line["order_id"] not in order_ids]
+
+
+def test_partial_insert_is_removed_without_transactions(monkeypatch):
+    orders = FakeOrders()
+    monkeypatch.setattr(orders_service, "orders_collection", orders)
+    monkeypatch.setattr(orders_service, "cart_store", None)
+    monkeypatch.setattr(orders_service, "_transactions_supported", False)
+    lines = [orders_service.new_order_line("user", f"p{i}", 1, "address") for i in range(3)]
+    with pytest.raises(AutoReconnect):
+        asyncio.run(orders_service.write_checkout("user", lines, {f"p{i}": 1 for i in range(3)}))
+    assert orders.lines == []
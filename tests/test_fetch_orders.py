@@ -0,0 +1,30 @@
+from routes.orders_route import router
+import services.orders_service as orders_service
+
+
+def patch_find_page(monkeypatch):
+    calls = []
+
+    async def find_page(collection, query, sort_option, cursor=None, limit=20, projection=None):
+        calls.append((query, limit))
+        return [], None
+    monkeypatch.setattr(orders_service, "find_page", find_page)
+    return calls
+
+
+def test_fetch_orders_skips_unmigrated_documents(monkeypatch, client_for):
+    calls = patch_find_page(monkeypatch)
+    client = client_for(router)
+    response = client.post("/orders/fetch-orders?limit=5", json={"id": "user"})
+    assert response.status_code == 200
+    assert response.json()["nextCursor"] is None
+    assert calls == [({"user_id": "user", "orders": {"$exists": False}}, 5)]
+
+
+def test_fetch_orders_rejects_bad_limits(monkeypatch, client_for):
+    calls = patch_find_page(monkeypatch)
+    client = client_for(router)
+    for limit in (0, -1, orders_service.MAX_ORDERS_PAGE + 1):
+        response = client.post(f"/orders/fetch-orders?limit={limit}", json={"id": "user"})
+        assert response.status_code == 422
+    assert calls == []
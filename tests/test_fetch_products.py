@@ -0,0 +1,66 @@
+from bson import ObjectId
+from microservices.product_microservice import product_cache
+from routes.products_route import router
+import services.products_service as products_service
+
+
+class FakeProducts:
+    # answers the $in query get_products_by_ids makes
+    def __init__(self, products):
+        self.products = products
+        self.queries = 0
+
+    def find(self, query, projection=None):
+        self.queries += 1
+        ids = set(query["_id"]["$in"])
+        matches = [dict(product) for product in self.products if product["_id"] in ids]
+        if projection:
+            matches = [{key: value for key, value in product.items() if key == "_id" or key in projection}
+                       for product in matches]
+
+        async def rows():
+            for product in matches:
+                yield product
+        return rows()
+
+
+def patch_products(monkeypatch, products):
+    product_cache.clear()
+    collection = FakeProducts(products)
+    monkeypatch.setattr(products_service, "product_collection", collection)
+    return collection
+
+
+def test_fetch_products_returns_request_order_and_missing(monkeypatch, client_for):
+    products = [{"_id": ObjectId(), "name": f"product {i}", "price": i} for i in range(3)]
+    collection = patch_products(monkeypatch, products)
+    client = client_for(router)
+    unknown = str(ObjectId())
+    ids = [str(products[2]["_id"]), "not-an-id", str(products[0]["_id"]), unknown]
+    response = client.post("/products/fetch-products", json={"ids": ids})
+    assert response.status_code == 200
+    body = response.json()
+    assert [product["name"] for product in body["products"]] == ["product 2", "product 0"]
+    assert body["missing"] == ["not-an-id", unknown]
+    assert collection.queries == 1
+
+
+def test_fetch_products_projects_fields_and_caches_whole_documents(monkeypatch, client_for):
+    products = [{"_id": ObjectId(), "name": "lamp", "price": 10, "details": "bright"}]
+    collection = patch_products(monkeypatch, products)
+    client = client_for(router)
+    id = str(products[0]["_id"])
+    response = client.post("/products/fetch-products", json={"ids": [id], "fields": ["price"]})
+    assert response.json()["products"] == [{"_id": id, "price": 10}]
+    # projected results aren't cached, whole documents are
+    client.post("/products/fetch-products", json={"ids": [id]})
+    response = client.post("/products/fetch-products", json={"ids": [id], "fields": ["name"]})
+    assert response.json()["products"] == [{"_id": id, "name": "lamp"}]
+    assert collection.queries == 2
+
+
+def test_fetch_products_limits_the_number_of_ids(monkeypatch, client_for):
+    patch_products(monkeypatch, [])
+    client = client_for(router)
+    response = client.post("/products/fetch-products", json={"ids": [str(ObjectId()) for _ in range(51)]})
+    assert response.status_code == 422
@@ -0,0 +1,88 @@
+import asyncio
+import services.products_service as products_service
+
+
+class FakeUploads:
+    # the Image_Uploads operations the key checks use
+    def __init__(self):
+        self.documents = {}
+
+    async def insert_many(self, documents):
+        for document in documents:
+            self.documents[document["_id"]] = dict(document)
+
+    async def find_one_and_update(self, query, update, projection=None):
+        document = self.documents.get(query["_id"])
+        if document is None or any(document.get(field) != value for field, value in query.items()):
+            return None
+        document.update(update["$set"])
+        return {"_id": document["_id"]}
+
+    async def update_many(self, query, update):
+        for key in query["_id"]["$in"]:
+            if key in self.documents:
+                self.documents[key].update(update["$set"])
+
+
+def setup(monkeypatch, uploaded=()):
+    uploads = FakeUploads()
+    monkeypatch.setattr(products_service, "image_upload_collection", uploads)
+    monkeypatch.setattr(products_service, "presign_upload", lambda key, content_type: {"key": key})
+
+    async def head_key(key):
+        return {"ContentType": "image/png", "ContentLength": 100} if key in uploaded else None
+    monkeypatch.setattr(products_service, "head_key", head_key)
+    return uploads
+
+
+def issue(seller, count=2):
+    return [upload["key"] for upload in asyncio.run(
+        products_service.create_image_upload_urls(seller, ["image/png"] * count))]
+
+
+def test_only_keys_issued_to_the_seller_are_accepted(monkeypatch):
+    uploaded = set()
+    uploads = setup(monkeypatch, uploaded)
+    keys = issue("seller")
+    other_keys = issue("other")
+    uploaded.update(keys + other_keys)
+    assert asyncio.run(products_service.verify_uploaded_keys(other_keys, "seller")) is False
+    assert asyncio.run(products_service.verify_uploaded_keys(keys[:1] + other_keys[:1], "seller")) is False
+    # a failed check leaves nothing claimed
+    assert not any(document["claimed"] for document in uploads.documents.values())
+    assert asyncio.run(products_service.verify_uploaded_keys(["1700000000000_123456789"], "seller")) is False
+    urls = asyncio.run(products_service.verify_uploaded_keys(keys, "seller"))
+    assert [url["original"] for url in urls] == [products_service.object_url(key) for key in keys]
+
+
+def test_claimed_keys_cant_be_used_again(monkeypatch):
+    uploaded = set()
+    setup(monkeypatch, uploaded)
+    keys = issue("seller")
+    uploaded.update(keys)
+    assert asyncio.run(products_service.verify_uploaded_keys(keys, "seller"))
+    assert asyncio.run(products_service.verify_uploaded_keys(keys, "seller")) is False
+    assert asyncio.run(products_service.verify_uploaded_keys([keys[0], keys[0]], "seller")) is False
+
+
+def test_missing_upload_releases_the_keys(monkeypatch):
+    uploaded = set()
+    setup(monkeypatch, uploaded)
+    keys = issue("seller")
+    uploaded.add(keys[0])
+    assert asyncio.run(products_service.verify_uploaded_keys(keys, "seller")) is False
+    uploaded.add(keys[1])
+    assert asyncio.run(products_service.verify_uploaded_keys(keys, "seller"))
+
+
+def test_rollback_keeps_content_addressed_images(monkeypatch):
+    deleted = []
+
+    async def delete_keys(keys):
+        deleted.extend(keys)
+    monkeypatch.setattr(products_service, "delete_keys", delete_keys)
+    content_key = products_service.generate_content_key("ab" * 32)
+    urls = [products_service.object_url(key) for key in
+            (content_key, f"{content_key}_card.webp", "1700000000000_123456789")]
+    asyncio.run(products_service.delete_uploaded_images(urls))
+    assert deleted == ["1700000000000_123456789"]
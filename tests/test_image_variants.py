@@ -0,0 +1,31 @@
+import asyncio
+import os
+import tempfile
+from io import BytesIO
+from PIL import Image
+from microservices.image_microservice import IMAGE_VARIANT_WIDTHS, make_image_variants, shutdown_image_pool
+
+
+def spooled_image(width, height, max_size):
+    # an upload the way starlette keeps it, in memory or rolled over to disk
+    file = tempfile.SpooledTemporaryFile(max_size=max_size)
+    Image.new("RGB", (width, height), "red").save(file, "PNG")
+    file.seek(0)
+    return file
+
+
+def test_variants_are_rendered_from_the_spooled_upload():
+    temp_files = set(os.listdir(tempfile.gettempdir()))
+    try:
+        for max_size in (1024 * 1024, 1):
+            file = spooled_image(2000, 1000, max_size)
+            variants = asyncio.run(make_image_variants(file))
+            for name, width in IMAGE_VARIANT_WIDTHS.items():
+                with Image.open(BytesIO(variants[name])) as variant:
+                    assert variant.format == "WEBP"
+                    assert variant.size == (width, width // 2)
+            # the upload is left ready to be sent to S3
+            assert file.tell() == 0
+    finally:
+        shutdown_image_pool()
+    assert {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("upload_")} <= temp_files
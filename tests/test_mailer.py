@@ -0,0 +1,72 @@
+import asyncio
+from microservices.mail_microservice import Mailer
+from schemas.auth_schemas import conf
+
+
+class FakeSMTP:
+    # fails the sends listed in errors, in order, and records the rest
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+        self.is_connected = True
+
+    async def send_message(self, message):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(message["To"])
+
+    async def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_mailer(errors, **kwargs):
+    mailer = Mailer(conf, connections=1, **kwargs)
+    smtp = FakeSMTP(errors)
+
+    async def connect():
+        mailer.open_connections += 1
+        return smtp
+    mailer._connect = connect
+    return mailer, smtp
+
+
+def test_unexpected_error_doesnt_stop_the_worker():
+    async def run():
+        mailer, smtp = make_mailer([RuntimeError("bug")])
+        mailer.enqueue(mailer.build_message("a@example.com", "hi", "body"))
+        mailer.enqueue(mailer.build_message("b@example.com", "hi", "body"))
+        await asyncio.wait_for(mailer.queue.join(), 5)
+        await mailer.stop()
+        return mailer, smtp
+    mailer, smtp = asyncio.run(run())
+    assert smtp.sent == ["b@example.com"]
+    assert mailer.failed == 1
+
+
+def test_stop_sends_waiting_retries():
+    async def run():
+        mailer, smtp = make_mailer([OSError("connection reset")], retry_seconds=60)
+        mailer.enqueue(mailer.build_message("a@example.com", "hi", "body"))
+        await asyncio.wait_for(mailer.queue.join(), 5)
+        assert len(mailer.pending_retries) == 1
+        await mailer.stop()
+        return mailer, smtp
+    mailer, smtp = asyncio.run(run())
+    assert smtp.sent == ["a@example.com"]
+    assert mailer.pending_retries == {}
+
+
+def test_start_replaces_ended_workers():
+    async def run():
+        mailer, smtp = make_mailer([])
+        mailer.start()
+        mailer.workers[0].cancel()
+        await asyncio.gather(*mailer.workers, return_exceptions=True)
+        mailer.enqueue(mailer.build_message("a@example.com", "hi", "body"))
+        await asyncio.wait_for(mailer.queue.join(), 5)
+        await mailer.stop()
+        return smtp
+    assert asyncio.run(run()).sent == ["a@example.com"]
@@ -0,0 +1,75 @@
+import asyncio
+import base64
+from microservices.pagination_microservice import encode_cursor
+import routes.products_route as products_route
+import services.products_service as products_service
+from services.products_service import build_product_query_pipeline, get_sort_option
+
+
+def patch_search(monkeypatch, ids):
+    sessions = []
+
+    async def get_search_session(search_token, search, category, sort_option):
+        sessions.append(search_token)
+        return {"token": "token", "ids": ids}
+
+    async def get_search_page(session, skip_count, per_page):
+        return [{"_id": str(id), "name": f"product {id}", "price": id, "images": []}
+                for id in session["ids"][skip_count:skip_count + per_page]]
+    monkeypatch.setattr(products_route, "get_search_session", get_search_session)
+    monkeypatch.setattr(products_route, "get_search_page", get_search_page)
+    return sessions
+
+
+def test_search_pages_follow_next_cursor(monkeypatch, client_for):
+    sessions = patch_search(monkeypatch, list(range(5)))
+    client = client_for(products_route.router)
+    seen = []
+    cursor = None
+    while True:
+        params = {"search": "hose", "per_page": 2, **({"cursor": cursor} if cursor else {})}
+        body = client.get("/products/products-query", params=params).json()
+        seen += [product["_id"] for product in body["products"]]
+        cursor = body["nextCursor"]
+        if cursor is None:
+            break
+    assert seen == [str(id) for id in range(5)]
+    # later pages reuse the ranked search
+    assert sessions == [None, "token", "token"]
+
+
+def test_malformed_cursors_are_rejected(monkeypatch, client_for):
+    patch_search(monkeypatch, list(range(5)))
+    client = client_for(products_route.router)
+    cursors = [
+        "not base64!",
+        base64.urlsafe_b64encode(b"[1, 2]").decode(),
+        base64.urlsafe_b64encode(b"{").decode(),
+        encode_cursor({"price": {"$ne": None}, "_id": 1}),
+        encode_cursor({"searchToken": "token", "offset": -2}),
+    ]
+    for cursor in cursors:
+        response = client.get("/products/products-query", params={"search": "hose", "cursor": cursor})
+        assert response.status_code == 400, cursor
+
+
+def test_pipeline_keeps_the_sort_fields_for_the_cursor():
+    for sort_by in ("relevence", "high-to-low", "ratings"):
+        sort_option = get_sort_option(sort_by, "hose")
+        pipeline = asyncio.run(build_product_query_pipeline({}, {}, sort_option, 0, 8))
+        projection = pipeline[-1]["$project"]
+        assert all(field in projection for field in sort_option)
+
+
+def test_every_listing_sort_has_an_index(monkeypatch):
+    indexes = []
+
+    class FakeCollection:
+        async def create_index(self, keys, **kwargs):
+            indexes.append(keys)
+    monkeypatch.setattr(products_service, "product_collection", FakeCollection())
+    monkeypatch.setattr(products_service, "image_upload_collection", FakeCollection())
+    asyncio.run(products_service.ensure_product_indexes())
+    for sort_by in ("high-to-low", "low-to-high", "ratings"):
+        keys = list(get_sort_option(sort_by, None).items())
+        assert keys in indexes and [("category", 1), *keys] in indexes, sort_by
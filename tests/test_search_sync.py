@@ -0,0 +1,65 @@
+import asyncio
+from datetime import datetime, timezone
+from bson import ObjectId
+import pytest
+from microservices.search_microservice import SearchIndex
+import microservices.search_sync_microservice as search_sync
+
+
+class FakeProducts:
+    # answers every poll with the same products, like the replayed updated_at window does
+    def __init__(self, products, polls):
+        self.products = products
+        self.polls = polls
+
+    def find(self, query, projection=None):
+        async def to_list(length):
+            self.polls -= 1
+            if self.polls < 0:
+                raise asyncio.CancelledError
+            return [dict(product) for product in self.products]
+        return type("Cursor", (), {"to_list": staticmethod(to_list)})()
+
+
+def run_polls(monkeypatch, products, polls):
+    index = SearchIndex()
+    index.rebuild([], datetime.now(timezone.utc))
+    monkeypatch.setattr(search_sync, "search_index", index)
+    monkeypatch.setattr(search_sync, "product_collection", FakeProducts(products, polls))
+    monkeypatch.setattr(search_sync, "POLL_INTERVAL", 0)
+    monkeypatch.setitem(search_sync.sync_state, "events_applied", 0)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(search_sync.poll_product_changes())
+    return index
+
+
+def product(name, **fields):
+    return {"_id": ObjectId(), "name": name, "category": "tools", "tags": ["garden"],
+            "updated_at": datetime.now(timezone.utc), **fields}
+
+
+def test_polling_the_same_product_again_leaves_the_index_alone(monkeypatch):
+    index = run_polls(monkeypatch, [product("green hose")], 5)
+    # indexed once, the four polls after it find nothing new
+    assert index.generation == 1
+    assert search_sync.sync_state["events_applied"] == 1
+
+
+def test_upsert_of_unchanged_product_keeps_the_compiled_index():
+    index = SearchIndex()
+    first = product("green hose")
+    index.rebuild([first])
+    index._compile()
+    generation = index.generation
+    assert index.upsert_product(dict(first)) is False
+    assert index.generation == generation and index._compiled is not None
+    assert index.upsert_product({**first, "tags": ["lawn"]}) is True
+    assert index.generation > generation
+
+
+def test_a_bad_product_doesnt_stop_polling(monkeypatch):
+    bad = {"_id": ObjectId(), "name": "no category", "tags": [], "updated_at": datetime.now(timezone.utc)}
+    good = product("green hose")
+    index = run_polls(monkeypatch, [bad, good], 3)
+    assert set(index.products) == {good["_id"]}
+    assert search_sync.sync_state["events_applied"] == 1